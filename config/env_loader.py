@@ -271,6 +271,16 @@ class EnvironmentConfig:
         """Maximum concurrent model inference requests."""
         return self.get_int("MAX_CONCURRENT_REQUESTS", 3)
     
+    @property
+    def langdetect_fallback(self) -> bool:
+        """Run langdetect on messages the Turkish letter/word heuristic does not settle."""
+        return self.get_bool("LANGDETECT_FALLBACK", False)
+    
+    @property
+    def answer_cache(self) -> bool:
+        """Answer paraphrases of liked questions from an embedding cache instead of the AI worker."""
+        return self.get_bool("ANSWER_CACHE", False)
+    
     # =============================================================================
     # DEVELOPMENT CONFIGURATION
     # =============================================================================
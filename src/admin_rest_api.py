@@ -6,8 +6,8 @@ from pydantic import BaseModel
 from typing import List, Optional, Union, Generic, TypeVar
 from datetime import datetime
 from sqlalchemy import func, text
-from database_models import SessionLocal, RawData, TrainingData, mark_duplicate_questions, mark_duplicate_answers, get_vote_statistics
-from error_handler import handle_database_error, handle_api_error, ErrorLevel
+from database_models import SessionLocal, RawData, TrainingData, mark_duplicate_questions, mark_duplicate_answers, rescan_all_duplicates, get_vote_statistics
+from error_handler import handle_api_error, make_database_error_handler, ErrorLevel
 import uvicorn
 import os
 import psutil
@@ -28,6 +28,10 @@ logger = logging.getLogger(__name__)
 
 T = TypeVar('T')
 
+# Per-route database error handlers
+handle_raw_data_select_error = make_database_error_handler("select", "raw_data")
+handle_raw_data_update_error = make_database_error_handler("update", "raw_data")
+
 # Load environment variables
 config = load_config()
 
@@ -188,7 +192,7 @@ def get_raw_data(
             has_prev=page > 1
         )
     except Exception as e:
-        error_response = handle_database_error(e, "select", "raw_data")
+        error_response = handle_raw_data_select_error(e)
         raise HTTPException(status_code=500, detail=error_response["error"]["message"])
     finally:
         db.close()
@@ -211,7 +215,7 @@ def update_answer(item_id: int, request: UpdateAnswerRequest):
         raise
     except Exception as e:
         db.rollback()
-        error_response = handle_database_error(e, "update", "raw_data")
+        error_response = handle_raw_data_update_error(e)
         raise HTTPException(status_code=500, detail=error_response["error"]["message"])
     finally:
         db.close()
@@ -450,29 +454,10 @@ def detect_duplicates():
         
         db.commit()
         
-        # Process raw data for duplicate questions
-        raw_data_entries = db.query(RawData).all()
-        question_duplicates_found = 0
-        
-        logger.info(f"Starting duplicate detection for {len(raw_data_entries)} raw data entries")
-        
-        for entry in raw_data_entries:
-            if entry.question and len(entry.question.strip()) > 10:  # Only process meaningful questions
-                was_duplicate = mark_duplicate_questions(db, entry.id, entry.question)
-                if was_duplicate:
-                    question_duplicates_found += 1
-        
-        # Process training data for duplicate answers
-        training_data_entries = db.query(TrainingData).all()
-        answer_duplicates_found = 0
-        
-        logger.info(f"Starting duplicate detection for {len(training_data_entries)} training data entries")
-        
-        for entry in training_data_entries:
-            if entry.answer and len(entry.answer.strip()) > 10:  # Only process meaningful answers
-                was_duplicate = mark_duplicate_answers(db, entry.id, entry.answer)
-                if was_duplicate:
-                    answer_duplicates_found += 1
+        # Re-scan raw data questions and training data answers
+        counts = rescan_all_duplicates(db)
+        question_duplicates_found = counts["question_duplicates"]
+        answer_duplicates_found = counts["answer_duplicates"]
         
         return {
             "success": True,
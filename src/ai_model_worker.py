@@ -4,24 +4,48 @@ import logging
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from sqlalchemy.orm import Session
 from database_models import SessionLocal, RawData
 from llama_model_handler import model_instance
 from config.env_loader import load_config
 import time
 
+# Optional fast JSON for RabbitMQ message bodies
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+def dumps_message(data: dict) -> bytes:
+    """Encode a RabbitMQ message body"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+def loads_message(body: bytes) -> dict:
+    """Decode a RabbitMQ message body"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(body)
+    return json.loads(body)
+
 class RabbitMQWorker:
     def __init__(self):
         self.config = load_config()
         self.connection = None
         self.channel = None
+        # Questions in flight at once; model_instance batches their generate() calls
+        self.concurrency = model_instance.config.batch_max_size
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="question")
         self.connect()
         
     def connect(self):
@@ -45,10 +69,31 @@ class RabbitMQWorker:
             raise
     
     def process_question(self, ch, method, properties, body):
-        """Process incoming question"""
+        """Hand an incoming question to the thread pool, so several can be generated in one batch"""
+        self.executor.submit(self.handle_question, ch, method.delivery_tag, body)
+    
+    def on_connection_thread(self, callback, *args, **kwargs):
+        """Run a channel operation on the connection's thread; pika channels are not thread-safe"""
+        self.connection.add_callback_threadsafe(partial(callback, *args, **kwargs))
+    
+    def publish_answer(self, ch, delivery_tag, answer_data):
+        """Publish an answer and acknowledge its question (connection thread)"""
+        ch.basic_publish(
+            exchange='',
+            routing_key='answers',
+            body=dumps_message(answer_data),
+            properties=pika.BasicProperties(
+                delivery_mode=2,  # make message persistent
+            )
+        )
+        logger.info(f"✅ RabbitMQ: Answer sent for question ID: {answer_data['raw_data_id']}")
+        ch.basic_ack(delivery_tag=delivery_tag)
+    
+    def handle_question(self, ch, delivery_tag, body):
+        """Process incoming question (worker thread)"""
         try:
             # Parse message
-            data = json.loads(body)
+            data = loads_message(body)
             logger.info(f"🔄 RabbitMQ: Processing question: {data['question'][:50]}...")
             
             db = SessionLocal()
@@ -64,7 +109,7 @@ class RabbitMQWorker:
                     
                 if not raw_data:
                     logger.error(f"RawData with id {data['raw_data_id']} not found after 5 attempts")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    self.on_connection_thread(ch.basic_ack, delivery_tag=delivery_tag)
                     return
                 
                 # Generate response
@@ -86,27 +131,16 @@ class RabbitMQWorker:
                     'update_message_id': data.get('update_message_id')
                 }
                 
-                self.channel.basic_publish(
-                    exchange='',
-                    routing_key='answers',
-                    body=json.dumps(answer_data),
-                    properties=pika.BasicProperties(
-                        delivery_mode=2,  # make message persistent
-                    )
-                )
-                
-                logger.info(f"✅ RabbitMQ: Answer sent for question ID: {data['raw_data_id']}")
+                # Publish and acknowledge message
+                self.on_connection_thread(self.publish_answer, ch, delivery_tag, answer_data)
                 
             finally:
                 db.close()
             
-            # Acknowledge message
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            
         except Exception as e:
             logger.error(f"❌ RabbitMQ: Error processing question: {e}")
             # Reject and requeue
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            self.on_connection_thread(ch.basic_nack, delivery_tag=delivery_tag, requeue=True)
     
     def start_consuming(self):
         """Start consuming messages"""
@@ -118,8 +152,8 @@ class RabbitMQWorker:
         
         logger.info("Model loaded successfully. Starting to consume messages...")
         
-        # Set up consumer
-        self.channel.basic_qos(prefetch_count=1)
+        # Set up consumer; enough unacknowledged questions to fill one generation batch
+        self.channel.basic_qos(prefetch_count=self.concurrency)
         self.channel.basic_consume(
             queue='questions',
             on_message_callback=self.process_question
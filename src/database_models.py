@@ -16,16 +16,21 @@ Author: naholav
 """
 
 import asyncio
+import hashlib
+import heapq
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Text, Boolean, DateTime, Float, ForeignKey, text, Index
+from sqlalchemy import create_engine, event, Column, Integer, BigInteger, String, Text, Boolean, DateTime, Float, ForeignKey, text, Index, UniqueConstraint, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
 from sqlalchemy.sql import func
-from datetime import datetime
 import logging
 import re
+import threading
 from typing import List, Optional, Tuple
 
 # Configure logging
@@ -44,13 +49,30 @@ engine = create_engine(
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# Global TF-IDF vectorizer for similarity calculations
-vectorizer = TfidfVectorizer(
-    max_features=10000,
-    stop_words='english',
-    lowercase=True,
-    ngram_range=(1, 2)
-)
+@event.listens_for(engine, "connect")
+def configure_connection(dbapi_connection, connection_record):
+    """Apply the per-connection SQLite settings to each new connection."""
+    # journal_mode=WAL is stored in the database file by init_db; synchronous and
+    # the cache settings below only last for the connection that sets them
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=NORMAL")  # fsync at WAL checkpoints, not every commit
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # read pages through a 256 MiB memory map
+    cursor.close()
+
+# Word tokenizer for TF-IDF similarity (Unicode-aware, covers Turkish letters)
+TOKEN_RE = re.compile(r"(?u)\b\w{2,}\b")
+
+# Answers whose SimHash differs from the query in more bits are not scored
+SIMHASH_MAX_DISTANCE = 20
+
+# Global TF-IDF vectorizer for similarity scans, fitted on stored questions and
+# answers and refitted once the tables grow by VECTORIZER_REFIT_GROWTH
+VECTORIZER_REFIT_GROWTH = 0.10
+vectorizer: Optional[TfidfVectorizer] = None
+vectorizer_corpus_size: Optional[int] = None  # corpus size at the last fit attempt
+vectorizer_lock = threading.Lock()
 
 class RawData(Base):
     """
@@ -69,6 +91,7 @@ class RawData(Base):
     
     # Core content
     question = Column(Text, nullable=False)
+    question_clean = Column(Text, default=lambda ctx: clean_text(ctx.get_current_parameters().get('question')))  # clean_text(question), cached for similarity scans
     answer = Column(Text)
     language = Column(String(10))  # 'TR' or 'EN'
     
@@ -81,8 +104,9 @@ class RawData(Base):
     duplicate_of_id = Column(Integer, ForeignKey('raw_data.id'))
     similarity_score = Column(Float)  # Cosine similarity score
     
-    # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # Timestamps (taken from the database clock; the client-side default keeps
+    # tables created before server_default was declared covered)
+    created_at = Column(DateTime, default=func.now(), server_default=func.now())
     answered_at = Column(DateTime)
     
     # Additional metadata
@@ -103,7 +127,7 @@ class RawData(Base):
     
     # Admin features
     admin_notes = Column(Text)  # Admin comments
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relationships
     training_data = relationship("TrainingData", back_populates="source")
@@ -124,6 +148,8 @@ class TrainingData(Base):
     # Core content
     question = Column(Text, nullable=False)
     answer = Column(Text, nullable=False)
+    answer_clean = Column(Text, default=lambda ctx: clean_text(ctx.get_current_parameters().get('answer')))  # clean_text(answer), cached for similarity scans
+    answer_simhash = Column(BigInteger, default=lambda ctx: simhash(clean_text(ctx.get_current_parameters().get('answer'))))  # 64-bit SimHash of answer_clean
     language = Column(String(10))  # 'TR' or 'EN'
     
     # Duplicate detection for answers
@@ -157,9 +183,9 @@ class TrainingData(Base):
     is_active = Column(Boolean, default=True)  # Active in training
     
     # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=func.now(), server_default=func.now())
     last_used_at = Column(DateTime)  # Last training run
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relationships
     source = relationship("RawData", back_populates="training_data")
@@ -178,6 +204,7 @@ Index('idx_training_data_source_id', TrainingData.source_id)
 Index('idx_training_data_language', TrainingData.language)
 Index('idx_training_data_review_status', TrainingData.review_status)
 Index('idx_training_data_is_active', TrainingData.is_active)
+Index('idx_training_data_active_created', TrainingData.is_active, TrainingData.created_at)
 
 class UserVotes(Base):
     """
@@ -192,13 +219,14 @@ class UserVotes(Base):
     vote_changes_count = Column(Integer, default=0)  # Max 2 changes allowed
     
     # Timestamps
-    first_vote_at = Column(DateTime, default=datetime.utcnow)
-    last_vote_at = Column(DateTime, default=datetime.utcnow)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    first_vote_at = Column(DateTime, default=func.now(), server_default=func.now())
+    last_vote_at = Column(DateTime, default=func.now(), server_default=func.now())
+    created_at = Column(DateTime, default=func.now(), server_default=func.now())
     
-    # Composite unique constraint
+    # Composite unique constraint (conflict target for the vote upsert)
     __table_args__ = (
         Index('idx_user_votes_composite', 'raw_data_id', 'telegram_user_id'),
+        UniqueConstraint('raw_data_id', 'telegram_user_id', name='uq_vote'),
     )
 
 class UserAnalytics(Base):
@@ -229,8 +257,8 @@ class UserAnalytics(Base):
     # Timestamps
     first_interaction = Column(DateTime)
     last_interaction = Column(DateTime)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=func.now(), server_default=func.now())
+    updated_at = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
 
 class SystemMetrics(Base):
     """
@@ -249,7 +277,7 @@ class SystemMetrics(Base):
     tags = Column(Text)  # Additional tags (JSON format)
     
     # Timestamps
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=func.now(), server_default=func.now())
     
     # Additional details
     details = Column(Text)  # Additional metric details (JSON format)
@@ -276,6 +304,171 @@ def clean_text(text: str) -> str:
     
     return text
 
+def hash_tokens(text: str) -> np.ndarray:
+    """
+    Hash the whitespace tokens of a cleaned text into a sorted unique array.
+    
+    Args:
+        text: Cleaned text (see clean_text)
+        
+    Returns:
+        Sorted array of unique int64 token hashes
+    """
+    return np.unique(np.fromiter((hash(token) for token in text.split()), dtype=np.int64))
+
+def simhash(text: str) -> int:
+    """
+    Compute a 64-bit SimHash over the term-frequency weighted tokens of a cleaned text.
+    
+    Token hashes come from blake2b rather than hash() so the value is stable
+    across processes and can be stored in the database.
+    
+    Args:
+        text: Cleaned text (see clean_text)
+        
+    Returns:
+        SimHash as a signed 64-bit integer (SQLite INTEGER range)
+    """
+    weights = [0] * 64
+    for token, count in Counter(text.split()).items():
+        token_hash = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += count if token_hash >> bit & 1 else -count
+    
+    value = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def simhash_distance(hash1: int, hash2: int) -> int:
+    """
+    Hamming distance between two SimHash values.
+    """
+    return bin((hash1 ^ hash2) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+def jaccard_similarity(tokens1: np.ndarray, tokens2: np.ndarray) -> float:
+    """
+    Jaccard similarity between two hash_tokens arrays.
+    """
+    intersection = np.intersect1d(tokens1, tokens2, assume_unique=True).size
+    union = tokens1.size + tokens2.size - intersection
+    return intersection / union if union else 0.0
+
+def _corpus_size(db: Session) -> int:
+    """
+    Cheap growth measure for the vectorizer corpus (max ids instead of COUNT scans).
+    """
+    max_question_id = db.query(func.max(RawData.id)).scalar() or 0
+    max_answer_id = db.query(func.max(TrainingData.id)).scalar() or 0
+    return max_question_id + max_answer_id
+
+def _vectorizer_is_stale(corpus_size: int) -> bool:
+    """Whether the corpus was never fitted or has grown past VECTORIZER_REFIT_GROWTH since"""
+    return vectorizer_corpus_size is None or corpus_size > vectorizer_corpus_size * (1 + VECTORIZER_REFIT_GROWTH)
+
+def refit_global_vectorizer(db: Session, force: bool = True) -> Optional[TfidfVectorizer]:
+    """
+    Fit the global TF-IDF vectorizer on all stored questions and answers.
+    
+    Args:
+        db: Database session
+        force: Refit even if the vectorizer is no longer stale once the lock is held
+        
+    Returns:
+        The fitted vectorizer, or the previous one if there is nothing to fit
+    """
+    global vectorizer, vectorizer_corpus_size
+    
+    with vectorizer_lock:
+        corpus_size = _corpus_size(db)
+        if not force and not _vectorizer_is_stale(corpus_size):
+            # Another thread refitted while this one waited for the lock
+            return vectorizer
+        
+        corpus = [doc for (doc,) in db.query(RawData.question_clean).filter(RawData.question_clean.isnot(None)) if doc]
+        corpus += [doc for (doc,) in db.query(TrainingData.answer_clean).filter(TrainingData.answer_clean.isnot(None)) if doc]
+        
+        fitted_vectorizer = TfidfVectorizer(
+            max_features=10000,
+            stop_words=None,
+            lowercase=True,
+            ngram_range=(1, 1),
+            min_df=1,
+            token_pattern=None,
+            tokenizer=TOKEN_RE.findall,
+            analyzer='word'
+        )
+        
+        try:
+            fitted_vectorizer.fit(corpus)
+        except ValueError as e:
+            # Empty corpus or vocabulary
+            logger.warning(f"Global TF-IDF vectorizer not fitted: {e}")
+            # Not retried until the corpus grows
+            vectorizer_corpus_size = corpus_size
+            return vectorizer
+        
+        vectorizer = fitted_vectorizer
+        vectorizer_corpus_size = corpus_size
+        logger.info(f"Global TF-IDF vectorizer fitted on {len(corpus)} documents")
+        return vectorizer
+
+def get_global_vectorizer(db: Session) -> Optional[TfidfVectorizer]:
+    """
+    Return the global TF-IDF vectorizer, refitting it if the corpus has grown.
+    
+    Args:
+        db: Database session
+        
+    Returns:
+        Fitted vectorizer, or None if no documents are stored yet
+    """
+    if _vectorizer_is_stale(_corpus_size(db)):
+        return refit_global_vectorizer(db, force=False)
+    return vectorizer
+
+def calculate_batch_similarity(db: Session, query_clean: str, candidate_cleans: List[str]) -> np.ndarray:
+    """
+    Score one cleaned text against many using the global TF-IDF vectorizer.
+    
+    Follows calculate_clean_similarity: identical texts score 1.0, empty texts
+    0.0, and Jaccard similarity is used where the TF-IDF score is zero. Words
+    missing from the fitted vocabulary do not contribute to the TF-IDF score.
+    
+    Args:
+        db: Database session
+        query_clean: Cleaned query text
+        candidate_cleans: Cleaned candidate texts
+        
+    Returns:
+        Array of similarity scores aligned with candidate_cleans
+    """
+    scores = np.zeros(len(candidate_cleans), dtype=np.float64)
+    if not query_clean or not candidate_cleans:
+        return scores
+    
+    fitted_vectorizer = get_global_vectorizer(db)
+    if fitted_vectorizer is None:
+        for i, candidate_clean in enumerate(candidate_cleans):
+            scores[i] = calculate_clean_similarity(query_clean, candidate_clean)
+        return scores
+    
+    tfidf_matrix = fitted_vectorizer.transform([query_clean] + candidate_cleans)
+    tfidf_scores = cosine_similarity(tfidf_matrix[1:], tfidf_matrix[0:1]).ravel()
+    query_tokens = hash_tokens(query_clean)
+    
+    for i, candidate_clean in enumerate(candidate_cleans):
+        if not candidate_clean:
+            continue
+        if candidate_clean == query_clean:
+            scores[i] = 1.0
+        elif tfidf_scores[i] > 0.0:
+            scores[i] = tfidf_scores[i]
+        else:
+            candidate_tokens = hash_tokens(candidate_clean)
+            if query_tokens.size and candidate_tokens.size:
+                scores[i] = jaccard_similarity(query_tokens, candidate_tokens)
+    
+    return scores
+
 def calculate_cosine_similarity(text1: str, text2: str) -> float:
     """
     Calculate cosine similarity between two texts using TF-IDF vectors.
@@ -287,11 +480,20 @@ def calculate_cosine_similarity(text1: str, text2: str) -> float:
     Returns:
         Cosine similarity score (0.0 to 1.0)
     """
-    try:
-        # Clean texts
-        clean_text1 = clean_text(text1)
-        clean_text2 = clean_text(text2)
+    return calculate_clean_similarity(clean_text(text1), clean_text(text2))
+
+def calculate_clean_similarity(clean_text1: str, clean_text2: str) -> float:
+    """
+    Calculate similarity between two texts already passed through clean_text.
+    
+    Args:
+        clean_text1: First cleaned text
+        clean_text2: Second cleaned text
         
+    Returns:
+        Cosine similarity score (0.0 to 1.0)
+    """
+    try:
         # Handle empty texts
         if not clean_text1 or not clean_text2:
             return 0.0
@@ -300,21 +502,15 @@ def calculate_cosine_similarity(text1: str, text2: str) -> float:
         if clean_text1 == clean_text2:
             return 1.0
         
-        # Simple word-based similarity using set intersection
-        words1 = set(clean_text1.split())
-        words2 = set(clean_text2.split())
+        # Simple word-based similarity over hashed token ids
+        tokens1 = hash_tokens(clean_text1)
+        tokens2 = hash_tokens(clean_text2)
         
         # Calculate Jaccard similarity as a fallback
-        if len(words1) == 0 or len(words2) == 0:
+        if tokens1.size == 0 or tokens2.size == 0:
             return 0.0
             
-        intersection = words1.intersection(words2)
-        union = words1.union(words2)
-        
-        if len(union) == 0:
-            return 0.0
-            
-        jaccard_score = len(intersection) / len(union)
+        jaccard_score = jaccard_similarity(tokens1, tokens2)
         
         # Try TF-IDF as primary method
         try:
@@ -329,7 +525,8 @@ def calculate_cosine_similarity(text1: str, text2: str) -> float:
                 lowercase=True,
                 ngram_range=(1, 1),  # Only unigrams for simplicity
                 min_df=1,
-                token_pattern=r'[a-zA-ZçÇğĞıIİöÖşŞüÜ]+',
+                token_pattern=None,
+                tokenizer=TOKEN_RE.findall,
                 analyzer='word'
             )
             
@@ -370,73 +567,104 @@ def find_similar_questions(db: Session, question: str, threshold: float = 0.45,
     """
     try:
         # Get recent questions first (more likely to be similar)
-        existing_questions = db.query(RawData.id, RawData.question)\
+        existing_questions = db.query(RawData.id, RawData.question, RawData.question_clean)\
+            .filter(RawData.question.isnot(None), func.length(func.trim(RawData.question)) > 0)\
             .order_by(RawData.created_at.desc())\
             .limit(limit)\
             .all()
         
-        similar_questions = []
-        
         # Pre-process the input question for better comparison
         question_cleaned = clean_text(question)
         
-        for existing_id, existing_question in existing_questions:
-            # Skip empty questions
-            if not existing_question or not existing_question.strip():
-                continue
-                
-            # Calculate similarity
-            similarity = calculate_cosine_similarity(question_cleaned, clean_text(existing_question))
-            
-            # Check if similarity exceeds threshold
-            if similarity >= threshold:
-                similar_questions.append((existing_id, existing_question, similarity))
+        # Calculate similarity on the cached cleaned text
+        similarities = calculate_batch_similarity(db, question_cleaned, [
+            existing_clean if existing_clean is not None else clean_text(existing_question)
+            for _, existing_question, existing_clean in existing_questions
+        ])
         
-        # Sort by similarity score (descending)
-        similar_questions.sort(key=lambda x: x[2], reverse=True)
+        # Keep scores above threshold, sorted by similarity score (descending)
+        selected = np.flatnonzero(similarities >= threshold)
+        selected = selected[np.argsort(-similarities[selected], kind='stable')]
         
-        return similar_questions
+        return [(existing_questions[i][0], existing_questions[i][1], float(similarities[i])) for i in selected]
         
     except Exception as e:
         logger.error(f"Error finding similar questions: {e}")
         return []
 
-def find_similar_answers(db: Session, answer: str, threshold: float = 0.85) -> List[Tuple[int, str, float]]:
+def find_similar_answers(db: Session, answer: str, threshold: float = 0.85, limit: int = 10,
+                         batch_size: int = 1000) -> List[Tuple[int, str, float]]:
     """
     Find similar answers in the training_data table.
     
+    Rows are streamed in id order in batches of batch_size. Once a match has
+    been found, the scan stops after two consecutive batches without any
+    SimHash-close candidate.
+    
     Args:
         db: Database session
         answer: Answer text to compare
         threshold: Similarity threshold (default: 0.8)
+        limit: Maximum number of matches to return (default: 10)
+        batch_size: Rows fetched per batch (default: 1000)
         
     Returns:
         List of tuples (id, answer, similarity_score)
     """
     try:
-        # Get all answers from training data
-        existing_answers = db.query(TrainingData.id, TrainingData.answer).all()
+        answer_cleaned = clean_text(answer)
+        answer_hash = simhash(answer_cleaned)
+        
+        # Stream active, non-duplicate answers from training data
+        result = db.execute(
+            select(TrainingData.id, TrainingData.answer, TrainingData.answer_clean, TrainingData.answer_simhash)
+            .where(
+                TrainingData.answer.isnot(None),
+                func.length(func.trim(TrainingData.answer)) > 0,
+                TrainingData.is_active.is_(True),
+                TrainingData.is_answer_duplicate.is_(False)
+            )
+            .order_by(TrainingData.id)
+            .execution_options(yield_per=batch_size)
+        )
         
         similar_answers = []
+        batches_without_candidates = 0
         
-        for existing_id, existing_answer in existing_answers:
-            # Calculate similarity
-            similarity = calculate_cosine_similarity(answer, existing_answer)
+        for partition in result.partitions():
+            # Skip candidates that are too far apart to reach the threshold
+            candidates = [
+                (existing_id, existing_answer, existing_clean if existing_clean is not None else clean_text(existing_answer))
+                for existing_id, existing_answer, existing_clean, existing_hash in partition
+                if existing_hash is None or simhash_distance(answer_hash, existing_hash) <= SIMHASH_MAX_DISTANCE
+            ]
             
-            # Check if similarity exceeds threshold
-            if similarity >= threshold:
-                similar_answers.append((existing_id, existing_answer, similarity))
-        
-        # Sort by similarity score (descending)
-        similar_answers.sort(key=lambda x: x[2], reverse=True)
+            if not candidates:
+                batches_without_candidates += 1
+                if similar_answers and batches_without_candidates >= 2:
+                    break
+                continue
+            batches_without_candidates = 0
+            
+            # Calculate similarity on the cached cleaned text
+            similarities = calculate_batch_similarity(db, answer_cleaned, [candidate[2] for candidate in candidates])
+            
+            # Keep the best matches so far, sorted by similarity score (descending)
+            similar_answers = heapq.nlargest(limit, similar_answers + [
+                (existing_id, existing_answer, float(similarity))
+                for (existing_id, existing_answer, _), similarity in zip(candidates, similarities)
+                if similarity >= threshold
+            ], key=lambda x: x[2])
         
+        result.close()
         return similar_answers
         
     except Exception as e:
         logger.error(f"Error finding similar answers: {e}")
         return []
 
-def mark_duplicate_questions(db: Session, question_id: int, question_text: str) -> bool:
+def mark_duplicate_questions(db: Session, question_id: int, question_text: str, commit: bool = True,
+                             similar_questions: Optional[List[Tuple[int, str, float]]] = None) -> bool:
     """
     Check for duplicate questions and mark them accordingly.
     Uses oldest question as the original reference.
@@ -445,13 +673,16 @@ def mark_duplicate_questions(db: Session, question_id: int, question_text: str)
         db: Database session
         question_id: ID of the question to check
         question_text: Text of the question
+        commit: Commit the changes (False leaves it to the caller's transaction)
+        similar_questions: Precomputed find_similar_questions result (searched if None)
         
     Returns:
         True if duplicates were found and marked
     """
     try:
         # Find similar questions
-        similar_questions = find_similar_questions(db, question_text, threshold=0.45)
+        if similar_questions is None:
+            similar_questions = find_similar_questions(db, question_text, threshold=0.45)
         
         # Remove the current question from results
         similar_questions = [sq for sq in similar_questions if sq[0] != question_id]
@@ -479,7 +710,8 @@ def mark_duplicate_questions(db: Session, question_id: int, question_text: str)
                 current_question.duplicate_of_id = oldest_id
                 current_question.similarity_score = similarity_score
                 
-                db.commit()
+                if commit:
+                    db.commit()
                 
                 logger.info(f"Question {question_id} marked as duplicate of {oldest_id} (similarity: {similarity_score:.3f})")
                 return True
@@ -490,7 +722,8 @@ def mark_duplicate_questions(db: Session, question_id: int, question_text: str)
         logger.error(f"Error marking duplicate questions: {e}")
         return False
 
-def mark_duplicate_answers(db: Session, training_id: int, answer_text: str) -> bool:
+def mark_duplicate_answers(db: Session, training_id: int, answer_text: str, commit: bool = True,
+                           similar_answers: Optional[List[Tuple[int, str, float]]] = None) -> bool:
     """
     Check for duplicate answers in training data and mark them accordingly.
     
@@ -498,13 +731,16 @@ def mark_duplicate_answers(db: Session, training_id: int, answer_text: str) -> b
         db: Database session
         training_id: ID of the training data entry
         answer_text: Text of the answer
+        commit: Commit the changes (False leaves it to the caller's transaction)
+        similar_answers: Precomputed find_similar_answers result (searched if None)
         
     Returns:
         True if duplicates were found and marked
     """
     try:
         # Find similar answers
-        similar_answers = find_similar_answers(db, answer_text, threshold=0.85)
+        if similar_answers is None:
+            similar_answers = find_similar_answers(db, answer_text, threshold=0.85)
         
         # Remove the current answer from results
         similar_answers = [sa for sa in similar_answers if sa[0] != training_id]
@@ -521,7 +757,8 @@ def mark_duplicate_answers(db: Session, training_id: int, answer_text: str) -> b
                 current_training.duplicate_answer_of_id = original_id
                 current_training.answer_similarity_score = similarity_score
                 
-                db.commit()
+                if commit:
+                    db.commit()
                 
                 logger.info(f"Answer {training_id} marked as duplicate of {original_id} (similarity: {similarity_score:.3f})")
                 return True
@@ -532,6 +769,69 @@ def mark_duplicate_answers(db: Session, training_id: int, answer_text: str) -> b
         logger.error(f"Error marking duplicate answers: {e}")
         return False
 
+def _search_in_worker_session(search, text: str) -> List[Tuple[int, str, float]]:
+    """
+    Run a similarity search on its own session so it can execute in a worker thread.
+    """
+    db = SessionLocal()
+    try:
+        return search(db, text)
+    finally:
+        db.close()
+
+def rescan_all_duplicates(db: Session, min_length: int = 10) -> dict:
+    """
+    Re-run duplicate detection over every stored question and training answer.
+    
+    Similarity searches are read-only and run in a thread pool, each on its own
+    session; the duplicate marks are then applied in id order on the caller's
+    session and committed once, giving the same result as a serial scan.
+    
+    Args:
+        db: Database session used to apply the duplicate marks
+        min_length: Skip texts at or below this many characters
+        
+    Returns:
+        Dict with question_duplicates and answer_duplicates counts
+    """
+    question_rows = [(entry_id, question) for entry_id, question in
+                     db.query(RawData.id, RawData.question).order_by(RawData.id).all()
+                     if question and len(question.strip()) > min_length]
+    answer_rows = [(entry_id, answer) for entry_id, answer in
+                   db.query(TrainingData.id, TrainingData.answer).order_by(TrainingData.id).all()
+                   if answer and len(answer.strip()) > min_length]
+    
+    logger.info(f"Starting duplicate rescan for {len(question_rows)} questions and {len(answer_rows)} answers")
+    
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        question_matches = list(executor.map(
+            lambda row: _search_in_worker_session(lambda s, q: find_similar_questions(s, q, threshold=0.45), row[1]),
+            question_rows
+        ))
+        answer_matches = list(executor.map(
+            lambda row: _search_in_worker_session(lambda s, a: find_similar_answers(s, a, threshold=0.85), row[1]),
+            answer_rows
+        ))
+    
+    question_duplicates = sum(
+        mark_duplicate_questions(db, entry_id, question, commit=False, similar_questions=matches)
+        for (entry_id, question), matches in zip(question_rows, question_matches)
+    )
+    # Answers flagged earlier in this pass are no longer duplicate candidates
+    answer_duplicates = 0
+    flagged_answers = set()
+    for (entry_id, answer), matches in zip(answer_rows, answer_matches):
+        matches = [match for match in matches if match[0] not in flagged_answers]
+        if mark_duplicate_answers(db, entry_id, answer, commit=False, similar_answers=matches):
+            flagged_answers.add(entry_id)
+            answer_duplicates += 1
+    db.commit()
+    
+    return {
+        "question_duplicates": question_duplicates,
+        "answer_duplicates": answer_duplicates
+    }
+
 def process_new_question(db: Session, question_data: dict) -> RawData:
     """
     Process a new question with duplicate detection.
@@ -547,11 +847,11 @@ def process_new_question(db: Session, question_data: dict) -> RawData:
         # Create new raw data entry
         raw_data = RawData(**question_data)
         db.add(raw_data)
-        db.commit()
-        db.refresh(raw_data)
+        db.flush()  # Assigns raw_data.id without committing
         
-        # Check for duplicates
-        mark_duplicate_questions(db, raw_data.id, raw_data.question)
+        # Check for duplicates and commit everything in one transaction
+        mark_duplicate_questions(db, raw_data.id, raw_data.question, commit=False)
+        db.commit()
         
         return raw_data
         
@@ -575,11 +875,11 @@ def process_new_training_data(db: Session, training_data: dict) -> TrainingData:
         # Create new training data entry
         training_entry = TrainingData(**training_data)
         db.add(training_entry)
-        db.commit()
-        db.refresh(training_entry)
+        db.flush()  # Assigns training_entry.id without committing
         
-        # Check for duplicate answers
-        mark_duplicate_answers(db, training_entry.id, training_entry.answer)
+        # Check for duplicate answers and commit everything in one transaction
+        mark_duplicate_answers(db, training_entry.id, training_entry.answer, commit=False)
+        db.commit()
         
         return training_entry
         
@@ -602,14 +902,36 @@ def handle_user_vote(db: Session, raw_data_id: int, telegram_user_id: int, vote_
         Dict with success status and message
     """
     try:
-        # Check if user has already voted
-        existing_vote = db.query(UserVotes).filter(
-            UserVotes.raw_data_id == raw_data_id,
-            UserVotes.telegram_user_id == telegram_user_id
-        ).first()
-        
-        if existing_vote:
-            # Check if user has exceeded change limit
+        vote_text = "👍 Liked!" if vote_type == 1 else "👎 Disliked!"
+        
+        # Insert the vote, or change the existing one if it differs and changes are left
+        stmt = sqlite_insert(UserVotes).values(
+            raw_data_id=raw_data_id,
+            telegram_user_id=telegram_user_id,
+            current_vote=vote_type,
+            vote_changes_count=0
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserVotes.raw_data_id, UserVotes.telegram_user_id],
+            set_={
+                "current_vote": vote_type,
+                "vote_changes_count": UserVotes.vote_changes_count + 1,
+                "last_vote_at": func.now()
+            },
+            where=or_(UserVotes.current_vote.is_(None), UserVotes.current_vote != vote_type)
+                  & (UserVotes.vote_changes_count < 2)
+        ).returning(UserVotes.vote_changes_count)
+        
+        vote_changes_count = db.execute(stmt).scalar()
+        db.commit()
+        
+        if vote_changes_count is None:
+            # Existing vote was left untouched; look up which rule rejected it
+            existing_vote = db.query(UserVotes).filter(
+                UserVotes.raw_data_id == raw_data_id,
+                UserVotes.telegram_user_id == telegram_user_id
+            ).first()
+            
             if existing_vote.vote_changes_count >= 2:
                 return {
                     "success": False,
@@ -617,53 +939,37 @@ def handle_user_vote(db: Session, raw_data_id: int, telegram_user_id: int, vote_
                     "changes_left": 0
                 }
             
-            # Check if trying to vote the same thing
-            if existing_vote.current_vote == vote_type:
-                return {
-                    "success": False,
-                    "message": "You already voted this way!",
-                    "changes_left": 2 - existing_vote.vote_changes_count
-                }
-            
-            # Update existing vote
-            existing_vote.current_vote = vote_type
-            existing_vote.vote_changes_count += 1
-            existing_vote.last_vote_at = datetime.utcnow()
-            
-            changes_left = 2 - existing_vote.vote_changes_count
-            vote_text = "👍 Liked!" if vote_type == 1 else "👎 Disliked!"
-            
-            if changes_left == 0:
-                message = f"{vote_text} (Last change!)"
-            else:
-                message = f"{vote_text} ({changes_left} changes left)"
-            
-            db.commit()
             return {
-                "success": True,
-                "message": message,
-                "changes_left": changes_left
+                "success": False,
+                "message": "You already voted this way!",
+                "changes_left": 2 - existing_vote.vote_changes_count
             }
-        else:
-            # Create new vote
-            new_vote = UserVotes(
-                raw_data_id=raw_data_id,
-                telegram_user_id=telegram_user_id,
-                current_vote=vote_type,
-                vote_changes_count=0
-            )
-            db.add(new_vote)
-            db.commit()
-            
-            vote_text = "👍 Liked!" if vote_type == 1 else "👎 Disliked!"
+        
+        if vote_changes_count == 0:
+            # New vote
             return {
                 "success": True,
                 "message": f"{vote_text} (2 changes available)",
                 "changes_left": 2
             }
         
+        # Changed vote
+        changes_left = 2 - vote_changes_count
+        
+        if changes_left == 0:
+            message = f"{vote_text} (Last change!)"
+        else:
+            message = f"{vote_text} ({changes_left} changes left)"
+        
+        return {
+            "success": True,
+            "message": message,
+            "changes_left": changes_left
+        }
+        
     except Exception as e:
         logger.error(f"Error handling user vote: {e}")
+        db.rollback()
         return {
             "success": False,
             "message": "Error saving vote",
@@ -747,6 +1053,65 @@ def get_database_statistics(db: Session) -> dict:
         logger.error(f"Error getting database statistics: {e}")
         return {}
 
+# Index DDL run by init_db as one script
+INDEX_DDL = """
+BEGIN;
+
+-- Raw data indexes
+CREATE INDEX IF NOT EXISTS idx_raw_data_telegram_id ON raw_data(telegram_id);
+CREATE INDEX IF NOT EXISTS idx_raw_data_language ON raw_data(language);
+CREATE INDEX IF NOT EXISTS idx_raw_data_created_at ON raw_data(created_at);
+CREATE INDEX IF NOT EXISTS idx_raw_data_is_duplicate ON raw_data(is_duplicate);
+CREATE INDEX IF NOT EXISTS idx_raw_data_admin_approved ON raw_data(admin_approved);
+CREATE INDEX IF NOT EXISTS idx_raw_data_like ON raw_data("like") WHERE "like" IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_raw_data_question ON raw_data(question);
+
+-- Training data indexes
+CREATE INDEX IF NOT EXISTS idx_training_data_source_id ON training_data(source_id);
+CREATE INDEX IF NOT EXISTS idx_training_data_language ON training_data(language);
+CREATE INDEX IF NOT EXISTS idx_training_data_is_active ON training_data(is_active);
+CREATE INDEX IF NOT EXISTS idx_training_data_is_answer_duplicate ON training_data(is_answer_duplicate);
+CREATE INDEX IF NOT EXISTS idx_training_data_review_status ON training_data(review_status);
+CREATE INDEX IF NOT EXISTS idx_training_data_active_created ON training_data(is_active, created_at);
+
+-- User analytics indexes
+CREATE INDEX IF NOT EXISTS idx_user_analytics_telegram_id ON user_analytics(telegram_id);
+
+-- User votes indexes
+CREATE INDEX IF NOT EXISTS idx_user_votes_raw_data_id ON user_votes(raw_data_id);
+CREATE INDEX IF NOT EXISTS idx_user_votes_telegram_user_id ON user_votes(telegram_user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_votes_unique ON user_votes(raw_data_id, telegram_user_id);
+
+-- System metrics indexes
+CREATE INDEX IF NOT EXISTS idx_system_metrics_name ON system_metrics(metric_name);
+CREATE INDEX IF NOT EXISTS idx_system_metrics_timestamp ON system_metrics(timestamp);
+
+COMMIT;
+"""
+
+# Full-text index over raw_data.question, kept in sync by triggers. The bot's
+# similarity lookup matches question words against it instead of LIKE '%...%'.
+QUESTION_FTS_DDL = """
+BEGIN;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS raw_data_fts USING fts5(question, content='raw_data', content_rowid='id');
+
+CREATE TRIGGER IF NOT EXISTS raw_data_fts_insert AFTER INSERT ON raw_data BEGIN
+    INSERT INTO raw_data_fts(rowid, question) VALUES (new.id, new.question);
+END;
+
+CREATE TRIGGER IF NOT EXISTS raw_data_fts_delete AFTER DELETE ON raw_data BEGIN
+    INSERT INTO raw_data_fts(raw_data_fts, rowid, question) VALUES ('delete', old.id, old.question);
+END;
+
+CREATE TRIGGER IF NOT EXISTS raw_data_fts_update AFTER UPDATE OF question ON raw_data BEGIN
+    INSERT INTO raw_data_fts(raw_data_fts, rowid, question) VALUES ('delete', old.id, old.question);
+    INSERT INTO raw_data_fts(rowid, question) VALUES (new.id, new.question);
+END;
+
+COMMIT;
+"""
+
 def init_db():
     """
     Initialize database and create all tables.
@@ -755,36 +1120,46 @@ def init_db():
         # Create all tables
         Base.metadata.create_all(bind=engine)
         
-        # Create indexes for performance
         with engine.connect() as conn:
-            # Raw data indexes
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_raw_data_telegram_id ON raw_data(telegram_id);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_raw_data_language ON raw_data(language);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_raw_data_created_at ON raw_data(created_at);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_raw_data_is_duplicate ON raw_data(is_duplicate);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_raw_data_admin_approved ON raw_data(admin_approved);"))
-            
-            # Training data indexes
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_training_data_source_id ON training_data(source_id);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_training_data_language ON training_data(language);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_training_data_is_active ON training_data(is_active);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_training_data_is_answer_duplicate ON training_data(is_answer_duplicate);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_training_data_review_status ON training_data(review_status);"))
-            
-            # User analytics indexes
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_user_analytics_telegram_id ON user_analytics(telegram_id);"))
-            
-            # User votes indexes
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_user_votes_raw_data_id ON user_votes(raw_data_id);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_user_votes_telegram_user_id ON user_votes(telegram_user_id);"))
-            conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_votes_unique ON user_votes(raw_data_id, telegram_user_id);"))
-            
-            # System metrics indexes
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_system_metrics_name ON system_metrics(metric_name);"))
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_system_metrics_timestamp ON system_metrics(timestamp);"))
+            # Cached similarity columns (added after the initial schema)
+            for table, column, column_type, source, compute in (
+                ("raw_data", "question_clean", "TEXT", "question", clean_text),
+                ("training_data", "answer_clean", "TEXT", "answer", clean_text),
+                ("training_data", "answer_simhash", "BIGINT", "answer", lambda value: simhash(clean_text(value))),
+            ):
+                existing_columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+                if column not in existing_columns:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+                
+                # Backfill rows stored before the column existed
+                pending = conn.execute(text(f"SELECT id, {source} FROM {table} WHERE {column} IS NULL")).fetchall()
+                if pending:
+                    conn.execute(
+                        text(f"UPDATE {table} SET {column} = :value WHERE id = :id"),
+                        [{"id": row_id, "value": compute(value)} for row_id, value in pending]
+                    )
+                    logger.info(f"Backfilled {column} for {len(pending)} {table} rows")
             
             conn.commit()
         
+        # Create indexes for performance in a single transaction
+        with engine.begin() as conn:
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+            conn.connection.executescript(INDEX_DDL)
+        
+        # Question full-text index; optional, since SQLite may be built without FTS5
+        try:
+            with engine.begin() as conn:
+                fts_exists = conn.exec_driver_sql(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'raw_data_fts'"
+                ).first() is not None
+                conn.connection.executescript(QUESTION_FTS_DDL)
+                if not fts_exists:
+                    # Index the questions stored before the table existed
+                    conn.exec_driver_sql("INSERT INTO raw_data_fts(raw_data_fts) VALUES ('rebuild')")
+        except Exception as e:
+            logger.warning(f"Question full-text index unavailable, similarity lookups use LIKE: {e}")
+        
         logger.info("SQLite database initialized successfully with all tables and indexes!")
         print("✅ Database initialized successfully!")
         
@@ -818,9 +1193,14 @@ __all__ = [
     'process_new_training_data',
     'mark_duplicate_questions',
     'mark_duplicate_answers',
+    'rescan_all_duplicates',
     'find_similar_questions',
     'find_similar_answers',
     'calculate_cosine_similarity',
+    'calculate_clean_similarity',
+    'calculate_batch_similarity',
+    'refit_global_vectorizer',
+    'clean_text',
     'handle_user_vote',
     'get_vote_statistics',
     'get_database_statistics'
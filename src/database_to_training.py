@@ -19,21 +19,100 @@ Author: naholav
 
 import json
 import os
+import re
+import sys
 import logging
 from datetime import datetime
-from typing import List, Dict, Optional
+from collections import Counter
+from array import array
+from typing import List, Dict, Optional, Iterator, BinaryIO, Collection, Iterable
 from pathlib import Path
 
+import numpy as np
+from sqlalchemy import Column, Integer, MetaData, Table, select
+
 # Import database models
 from database_models import SessionLocal, TrainingData, RawData
 
+# Fast JSON serialization (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Training entry validation rules
+REQUIRED_FIELDS = ('id', 'question', 'answer', 'language')
+MIN_QUESTION_LENGTH = 3
+MIN_ANSWER_LENGTH = 5
+
+# Ids per IN (...) query, below SQLite's bound parameter limit
+ID_CHUNK_SIZE = 500
+
+# Per-connection temp table of ids already in the training file, so the export
+# query can exclude them in SQL
+EXPORTED_IDS_TABLE = Table(
+    'exported_ids', MetaData(),
+    Column('id', Integer, primary_key=True),
+    prefixes=['TEMPORARY']
+)
+
+# Output buffer size for JSONL writes
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Top-level "id" value of a JSONL training entry (json.dump writes it first)
+ID_PATTERN = re.compile(rb'"id"\s*:\s*(\d+)')
+
+# Above this many ids, existing ids are kept in a SortedIdSet instead of a set
+COMPACT_ID_SET_THRESHOLD = 100_000
+
+class SortedIdSet:
+    """Read-only set of integer ids stored as a sorted int64 array (8 bytes per id)"""
+    
+    def __init__(self, ids: np.ndarray, extra_ids: Iterable = ()):
+        self.ids = np.unique(ids)
+        self.extra_ids = set(extra_ids)
+    
+    def __contains__(self, value) -> bool:
+        if isinstance(value, int):
+            index = np.searchsorted(self.ids, value)
+            return bool(index < self.ids.size and self.ids[index] == value)
+        return value in self.extra_ids
+    
+    def __iter__(self):
+        yield from self.ids.tolist()
+        yield from self.extra_ids
+    
+    def __len__(self) -> int:
+        return self.ids.size + len(self.extra_ids)
+
+def dumps_entry(entry: Dict) -> bytes:
+    """Serialize a training entry to UTF-8 JSON bytes"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(entry)
+    return json.dumps(entry, ensure_ascii=False).encode('utf-8')
+
+def loads_entry(line: bytes) -> Dict:
+    """Parse a training entry from a JSONL line"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(line)
+    return json.loads(line)
+
 class DatabaseToTrainingConverter:
     """Convert database training data to JSONL format for training"""
     
+    # Database language codes to training format
+    LANGUAGE_MAP = {
+        'TR': 'turkish',
+        'EN': 'english',
+        'turkish': 'turkish',
+        'english': 'english'
+    }
+    
     def __init__(self, base_path: str = "/home/ceng/cu_ceng_bot"):
         self.base_path = Path(base_path)
         self.data_dir = self.base_path / "data"
@@ -46,155 +125,273 @@ class DatabaseToTrainingConverter:
     
     def map_language(self, db_language: str) -> str:
         """Map database language codes to training format"""
-        language_map = {
-            'TR': 'turkish',
-            'EN': 'english',
-            'turkish': 'turkish',
-            'english': 'english'
-        }
-        return language_map.get(db_language, 'english')
+        return self.LANGUAGE_MAP.get(db_language, 'english')
     
     def validate_training_data(self, data: Dict) -> bool:
         """Validate training data entry"""
-        required_fields = ['id', 'question', 'answer', 'language']
-        
         # Check required fields
-        for field in required_fields:
-            if field not in data:
-                logger.warning(f"Missing required field: {field}")
-                return False
-            
-            if not data[field]:
-                logger.warning(f"Empty value for field: {field}")
+        for field in REQUIRED_FIELDS:
+            if not data.get(field):
+                if logger.isEnabledFor(logging.WARNING):
+                    if field not in data:
+                        logger.warning(f"Missing required field: {field}")
+                    else:
+                        logger.warning(f"Empty value for field: {field}")
                 return False
         
         # Check minimum content length
-        if len(data['question'].strip()) < 3:
-            logger.warning(f"Question too short: {data['question']}")
+        question = data['question']
+        if len(question.strip()) < MIN_QUESTION_LENGTH:
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning(f"Question too short: {question}")
             return False
-            
-        if len(data['answer'].strip()) < 5:
-            logger.warning(f"Answer too short: {data['answer']}")
+        
+        answer = data['answer']
+        if len(answer.strip()) < MIN_ANSWER_LENGTH:
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning(f"Answer too short: {answer}")
             return False
         
         return True
     
-    def backup_existing_file(self) -> Optional[Path]:
+    def validate_stripped(self, record_id: int, question: str, answer: str, language: str) -> bool:
+        """Validate an export row whose question and answer are already stripped"""
+        if record_id and language and len(question) >= MIN_QUESTION_LENGTH and len(answer) >= MIN_ANSWER_LENGTH:
+            return True
+        
+        if logger.isEnabledFor(logging.WARNING):
+            if len(question) < MIN_QUESTION_LENGTH:
+                logger.warning(f"Question too short: {question}")
+            elif len(answer) < MIN_ANSWER_LENGTH:
+                logger.warning(f"Answer too short: {answer}")
+        return False
+    
+    def backup_existing_file(self, file_path: Optional[Path] = None) -> Optional[Path]:
         """Create backup of existing training file"""
-        if not self.training_file.exists():
+        if file_path is None:
+            file_path = self.training_file
+        
+        if not file_path.exists():
             return None
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_file = self.backup_dir / f"cengbot_qa_augmented_backup_{timestamp}.jsonl"
+        backup_file = self.backup_dir / f"{file_path.stem}_backup_{timestamp}.jsonl"
         
         try:
             import shutil
-            shutil.copy2(self.training_file, backup_file)
+            import subprocess
+            try:
+                # Instant copy-on-write clone where the filesystem supports it
+                subprocess.run(['cp', '--reflink=auto', str(file_path), str(backup_file)],
+                               check=True, capture_output=True)
+            except (OSError, subprocess.CalledProcessError):
+                # Kernel-side copy (sendfile), without replicating metadata
+                shutil.copyfile(file_path, backup_file)
             logger.info(f"Created backup: {backup_file}")
             return backup_file
         except Exception as e:
             logger.error(f"Failed to create backup: {e}")
             return None
     
-    def export_from_database(self, include_inactive: bool = False) -> List[Dict]:
-        """Export training data from database"""
+    def iter_export_entries(self, include_inactive: bool = False, exclude_ids: Optional[Collection[int]] = None) -> Iterator[Dict]:
+        """Stream valid training entries from database, skipping records whose id is in exclude_ids"""
         db = SessionLocal()
-        exported_data = []
+        exclude_table = False
         
         try:
-            # Query training data
-            query = db.query(TrainingData)
+            # Query training data ids
+            id_query = db.query(TrainingData.id)
             
             # Filter active records only (unless specified)
             if not include_inactive:
-                query = query.filter(TrainingData.is_active == True)
+                id_query = id_query.filter(TrainingData.is_active == True)
+            
+            # Only fetch records that are not exported yet: the known ids go into a
+            # temp table and the query skips them with NOT IN
+            if exclude_ids:
+                connection = db.connection()
+                EXPORTED_IDS_TABLE.create(connection, checkfirst=True)
+                exclude_table = True
+                chunk = []
+                for record_id in exclude_ids:
+                    if isinstance(record_id, int):
+                        chunk.append({'id': record_id})
+                        if len(chunk) == ID_CHUNK_SIZE:
+                            connection.execute(EXPORTED_IDS_TABLE.insert(), chunk)
+                            chunk = []
+                if chunk:
+                    connection.execute(EXPORTED_IDS_TABLE.insert(), chunk)
+                id_query = id_query.filter(TrainingData.id.notin_(select(EXPORTED_IDS_TABLE.c.id)))
             
             # Order by creation date
-            query = query.order_by(TrainingData.created_at)
+            record_ids = [record_id for (record_id,) in id_query.order_by(TrainingData.created_at)]
+            
+            logger.info(f"Found {len(record_ids)} training records in database")
             
-            training_records = query.all()
+            # Stream records chunk by chunk instead of loading them all at once
+            training_records = (
+                record
+                for start in range(0, len(record_ids), ID_CHUNK_SIZE)
+                for record in db.query(TrainingData.id, TrainingData.question, TrainingData.answer, TrainingData.language)
+                    .filter(TrainingData.id.in_(record_ids[start:start + ID_CHUNK_SIZE]))
+                    .order_by(TrainingData.created_at)
+                    .yield_per(ID_CHUNK_SIZE)
+            )
             
-            logger.info(f"Found {len(training_records)} training records in database")
+            map_language = self.LANGUAGE_MAP.get
             
-            for record in training_records:
+            for record_id, question, answer, language in training_records:
                 # Convert database record to training format
-                training_entry = {
-                    "id": record.id,
-                    "question": record.question.strip(),
-                    "answer": record.answer.strip(),
-                    "language": self.map_language(record.language)
-                }
+                question = question.strip()
+                answer = answer.strip()
+                language = map_language(language, 'english')
                 
                 # Validate data
-                if self.validate_training_data(training_entry):
-                    exported_data.append(training_entry)
+                if self.validate_stripped(record_id, question, answer, language):
+                    yield {
+                        "id": record_id,
+                        "question": question,
+                        "answer": answer,
+                        "language": language
+                    }
                 else:
-                    logger.warning(f"Skipping invalid training record ID: {record.id}")
-            
-            logger.info(f"Successfully exported {len(exported_data)} valid training entries")
+                    logger.warning(f"Skipping invalid training record ID: {record_id}")
             
         except Exception as e:
             logger.error(f"Error exporting from database: {e}")
             raise
         finally:
+            # Temp tables live as long as the pooled connection, so drop it explicitly
+            if exclude_table:
+                db.rollback()
+                EXPORTED_IDS_TABLE.drop(db.connection(), checkfirst=True)
             db.close()
-        
+    
+    def export_from_database(self, include_inactive: bool = False, exclude_ids: Optional[Collection[int]] = None) -> List[Dict]:
+        """Export training data from database, skipping records whose id is in exclude_ids"""
+        exported_data = list(self.iter_export_entries(include_inactive=include_inactive, exclude_ids=exclude_ids))
+        logger.info(f"Successfully exported {len(exported_data)} valid training entries")
         return exported_data
     
-    def load_existing_data(self) -> List[Dict]:
-        """Load existing training data from JSONL file"""
-        if not self.training_file.exists():
-            return []
+    def stream_export(self, output: BinaryIO, include_inactive: bool = False, exclude_ids: Optional[Collection[int]] = None) -> Dict:
+        """Write training data from database straight to a binary JSONL stream in one pass and return statistics"""
+        language_counts = Counter()
+        total_question_length = 0
+        total_answer_length = 0
+        
+        for entry in self.iter_export_entries(include_inactive=include_inactive, exclude_ids=exclude_ids):
+            output.write(dumps_entry(entry) + b'\n')
+            language_counts[entry['language']] += 1
+            total_question_length += len(entry['question'])
+            total_answer_length += len(entry['answer'])
+        
+        total_entries = sum(language_counts.values())
+        logger.info(f"Successfully exported {total_entries} valid training entries")
+        
+        return {
+            "total_entries": total_entries,
+            "by_language": dict(language_counts),
+            "avg_question_length": total_question_length / total_entries if total_entries else 0,
+            "avg_answer_length": total_answer_length / total_entries if total_entries else 0
+        }
+    
+    def load_existing_data(self, file_path: Optional[Path] = None) -> Iterator[Dict]:
+        """Stream existing training data entries from JSONL file"""
+        if file_path is None:
+            file_path = self.training_file
+        
+        if not file_path.exists():
+            return
         
-        existing_data = []
         try:
-            with open(self.training_file, 'r', encoding='utf-8') as f:
+            with open(file_path, 'rb') as f:
                 for line in f:
                     line = line.strip()
                     if line:
-                        existing_data.append(json.loads(line))
-            
-            logger.info(f"Loaded {len(existing_data)} existing training entries")
-            return existing_data
+                        yield loads_entry(line)
             
         except Exception as e:
             logger.error(f"Error loading existing data: {e}")
-            return []
+    
+    def load_existing_ids(self, file_path: Optional[Path] = None) -> Collection[int]:
+        """Load the ids of existing training entries without decoding whole lines"""
+        if file_path is None:
+            file_path = self.training_file
+        
+        if not file_path.exists():
+            return set()
+        
+        numeric_ids = array('q')
+        other_ids = set()
+        try:
+            with open(file_path, 'rb') as f:
+                for line in f:
+                    match = ID_PATTERN.search(line)
+                    if match:
+                        numeric_ids.append(int(match.group(1)))
+                    elif line.strip():
+                        # Unusual layout (e.g. non-numeric id): fall back to a full decode
+                        other_ids.add(loads_entry(line).get('id'))
+            
+            # Large files get a compact sorted array instead of a hash set
+            if len(numeric_ids) > COMPACT_ID_SET_THRESHOLD:
+                existing_ids = SortedIdSet(np.frombuffer(numeric_ids, dtype=np.int64), other_ids)
+            else:
+                existing_ids = set(numeric_ids) | other_ids
+            
+            logger.info(f"Loaded {len(existing_ids)} existing training entry ids")
+            return existing_ids
+            
+        except Exception as e:
+            logger.error(f"Error loading existing ids: {e}")
+            return set()
+
+    def open_for_append(self, file_path: Path) -> BinaryIO:
+        """Open a JSONL file for appending, making sure new entries start on a fresh line"""
+        needs_newline = False
+        if file_path.exists() and file_path.stat().st_size > 0:
+            with open(file_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b'\n'
+        
+        f = open(file_path, 'ab', buffering=WRITE_BUFFER_SIZE)
+        if needs_newline:
+            f.write(b'\n')
+        return f
 
-    def save_to_jsonl(self, data: List[Dict], file_path: Optional[Path] = None, append_mode: bool = True) -> Path:
-        """Save training data to JSONL file"""
+    def sync_file(self, f: BinaryIO) -> None:
+        """Flush buffered writes and sync them to disk once"""
+        f.flush()
+        os.fsync(f.fileno())
+
+    def save_to_jsonl(self, data: List[Dict], file_path: Optional[Path] = None, append_mode: bool = True,
+                      existing_ids: Optional[Collection[int]] = None) -> Path:
+        """Save training data to JSONL file (append mode only writes entries not already in the file)"""
         if file_path is None:
             file_path = self.training_file
         
         try:
             if append_mode:
-                # Load existing data first
-                existing_data = self.load_existing_data()
-                
                 # Get existing IDs to avoid duplicates
-                existing_ids = set()
-                for entry in existing_data:
-                    existing_ids.add(entry.get('id'))
+                if existing_ids is None:
+                    existing_ids = self.load_existing_ids(file_path)
                 
                 # Filter out duplicates from new data
-                new_data = []
-                for entry in data:
-                    if entry.get('id') not in existing_ids:
-                        new_data.append(entry)
+                new_data = [entry for entry in data if entry.get('id') not in existing_ids]
                 
-                # Combine existing and new data
-                all_data = existing_data + new_data
-                logger.info(f"Appending {len(new_data)} new entries to {len(existing_data)} existing entries")
+                with self.open_for_append(file_path) as f:
+                    f.write(b''.join(dumps_entry(entry) + b'\n' for entry in new_data))
+                    self.sync_file(f)
+                
+                logger.info(f"Appended {len(new_data)} new entries to {len(existing_ids)} existing entries in {file_path}")
             else:
-                all_data = data
-            
-            # Save all data
-            with open(file_path, 'w', encoding='utf-8') as f:
-                for entry in all_data:
-                    json.dump(entry, f, ensure_ascii=False)
-                    f.write('\n')
+                # Save all data
+                with open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                    f.write(b''.join(dumps_entry(entry) + b'\n' for entry in data))
+                    self.sync_file(f)
+                
+                logger.info(f"Saved {len(data)} total training entries to {file_path}")
             
-            logger.info(f"Saved {len(all_data)} total training entries to {file_path}")
             return file_path
             
         except Exception as e:
@@ -212,36 +409,49 @@ class DatabaseToTrainingConverter:
             }
         
         # Count by language
-        language_counts = {}
-        total_question_length = 0
-        total_answer_length = 0
-        
-        for entry in data:
-            lang = entry['language']
-            language_counts[lang] = language_counts.get(lang, 0) + 1
-            total_question_length += len(entry['question'])
-            total_answer_length += len(entry['answer'])
+        language_counts = Counter(entry['language'] for entry in data)
+        total_question_length = sum(len(entry['question']) for entry in data)
+        total_answer_length = sum(len(entry['answer']) for entry in data)
         
         return {
             "total_entries": len(data),
-            "by_language": language_counts,
+            "by_language": dict(language_counts),
             "avg_question_length": total_question_length / len(data),
             "avg_answer_length": total_answer_length / len(data)
         }
     
-    def full_export(self, include_inactive: bool = False, create_backup: bool = True) -> Dict:
+    def full_export(self, include_inactive: bool = False, create_backup: bool = True,
+                    output_file: Optional[Path] = None) -> Dict:
         """Complete export process from database to training file"""
         logger.info("Starting full database to training data export...")
         
+        if output_file is None:
+            output_file = self.training_file
+        
         # Create backup if requested
         backup_file = None
         if create_backup:
-            backup_file = self.backup_existing_file()
+            backup_file = self.backup_existing_file(output_file)
+        
+        # Export records not yet in the training file from database, appending
+        # them to the file and collecting statistics in a single pass
+        existing_ids = self.load_existing_ids(output_file)
+        file_created = not output_file.exists()
         
-        # Export from database
-        training_data = self.export_from_database(include_inactive=include_inactive)
+        with self.open_for_append(output_file) as f:
+            new_statistics = self.stream_export(f, include_inactive=include_inactive, exclude_ids=existing_ids)
+            self.sync_file(f)
         
-        if not training_data:
+        # Statistics describe only the entries appended by this run
+        statistics = {
+            "new_entries": new_statistics.pop("total_entries"),
+            "existing_entries": len(existing_ids),
+            **new_statistics
+        }
+        
+        if not statistics["new_entries"] and not existing_ids:
+            if file_created:
+                output_file.unlink()
             logger.warning("No training data found in database")
             return {
                 "success": False,
@@ -249,16 +459,15 @@ class DatabaseToTrainingConverter:
                 "statistics": {}
             }
         
-        # Save to JSONL file (append mode by default)
-        output_file = self.save_to_jsonl(training_data, append_mode=True)
-        
-        # Get statistics
-        statistics = self.get_export_statistics(training_data)
+        # An append of nothing leaves the mtime alone; touch the file so its age
+        # (checked by train_model) reflects this export
+        os.utime(output_file)
         
         # Return results
         result = {
             "success": True,
-            "message": f"Successfully exported {len(training_data)} training entries",
+            "message": f"Successfully exported {statistics['new_entries']} new training entries "
+                       f"({statistics['existing_entries']} already in the file)",
             "output_file": str(output_file),
             "backup_file": str(backup_file) if backup_file else None,
             "statistics": statistics
@@ -274,17 +483,25 @@ def main():
     parser = argparse.ArgumentParser(description="Export database training data to JSONL format")
     parser.add_argument("--include-inactive", action="store_true", help="Include inactive training records")
     parser.add_argument("--no-backup", action="store_true", help="Skip creating backup file")
-    parser.add_argument("--output", type=str, help="Output file path (default: data/cengbot_qa_augmented.jsonl)")
+    parser.add_argument("--output", type=str, help="Output file path, or - for stdout (default: data/cengbot_qa_augmented.jsonl)")
     
     args = parser.parse_args()
     
     # Create converter
     converter = DatabaseToTrainingConverter()
     
+    # Stream straight to stdout (no backup or deduplication against a file)
+    if args.output == "-":
+        stats = converter.stream_export(sys.stdout.buffer, include_inactive=args.include_inactive)
+        sys.stdout.buffer.flush()
+        print(f"✅ Exported {stats['total_entries']} training entries to stdout", file=sys.stderr)
+        return 0
+    
     # Export data
     result = converter.full_export(
         include_inactive=args.include_inactive,
-        create_backup=not args.no_backup
+        create_backup=not args.no_backup,
+        output_file=Path(args.output) if args.output else None
     )
     
     # Print results
@@ -299,8 +516,9 @@ def main():
             print(f"💾 Backup file: {result['backup_file']}")
         
         stats = result['statistics']
-        print(f"\n📊 Statistics:")
-        print(f"  Total entries: {stats['total_entries']}")
+        print(f"\n📊 Statistics (new entries):")
+        print(f"  New entries: {stats['new_entries']}")
+        print(f"  Already in file: {stats['existing_entries']}")
         print(f"  By language: {stats['by_language']}")
         print(f"  Avg question length: {stats['avg_question_length']:.1f} chars")
         print(f"  Avg answer length: {stats['avg_answer_length']:.1f} chars")
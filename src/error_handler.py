@@ -3,12 +3,13 @@
 Centralized error handling for CengBot system
 """
 
+import functools
 import logging
-import traceback
 import sys
 import os
+import time
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable
 from enum import Enum
 
 class ErrorLevel(Enum):
@@ -17,6 +18,22 @@ class ErrorLevel(Enum):
     HIGH = "high"
     CRITICAL = "critical"
 
+# ErrorLevel -> (logging level, log tag, whether the traceback is logged)
+LEVEL_TO_LOG = {
+    ErrorLevel.CRITICAL: (logging.CRITICAL, "CRITICAL", True),
+    ErrorLevel.HIGH: (logging.ERROR, "HIGH", True),
+    ErrorLevel.MEDIUM: (logging.WARNING, "MEDIUM", True),
+    ErrorLevel.LOW: (logging.INFO, "LOW", False),
+}
+
+@functools.lru_cache(maxsize=1)
+def _iso_at_second(second: int) -> str:
+    return datetime.fromtimestamp(second).isoformat()
+
+def current_timestamp() -> str:
+    """ISO timestamp of the current second, formatted once per second"""
+    return _iso_at_second(int(time.time()))
+
 class ErrorHandler:
     """Centralized error handling and logging"""
     
@@ -77,27 +94,19 @@ class ErrorHandler:
             Dict containing error response information
         """
         error_data = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": current_timestamp(),
             "context": context,
             "level": level.value,
             "error_type": type(error).__name__,
             "error_message": str(error),
-            "traceback": traceback.format_exc(),
             "additional_data": additional_data or {}
         }
         
-        # Log based on severity
-        if level == ErrorLevel.CRITICAL:
-            self.logger.critical(f"CRITICAL ERROR in {context}: {error}")
-            self.logger.critical(f"Traceback: {traceback.format_exc()}")
-        elif level == ErrorLevel.HIGH:
-            self.logger.error(f"HIGH ERROR in {context}: {error}")
-            self.logger.error(f"Traceback: {traceback.format_exc()}")
-        elif level == ErrorLevel.MEDIUM:
-            self.logger.warning(f"MEDIUM ERROR in {context}: {error}")
-            self.logger.warning(f"Traceback: {traceback.format_exc()}")
-        else:
-            self.logger.info(f"LOW ERROR in {context}: {error}")
+        # Log based on severity; the traceback rides on the record as exc_info, so
+        # logging only formats it when a handler actually emits the record
+        log_level, tag, log_traceback = LEVEL_TO_LOG[level]
+        self.logger.log(log_level, "%s ERROR in %s: %s", tag, context, error,
+                        exc_info=error if log_traceback else None)
         
         # Return response
         return {
@@ -130,7 +139,7 @@ class ErrorHandler:
                 "value": str(value),
                 "expected": expected,
                 "context": context,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": current_timestamp()
             }
         }
     
@@ -250,4 +259,18 @@ def handle_telegram_error(error: Exception, user_id: Optional[int] = None, messa
 
 def handle_training_error(error: Exception, step: str, epoch: Optional[int] = None):
     """Convenience function for training errors"""
-    return error_handler.handle_training_error(error, step, epoch)
\ No newline at end of file
+    return error_handler.handle_training_error(error, step, epoch)
+
+# Pre-built handlers: context and additional data are prepared once, so callers
+# can create them at import time and call them with just the exception
+def make_database_error_handler(operation: str, table: Optional[str] = None) -> Callable[[Exception], Dict[str, Any]]:
+    """Build a database error handler for a fixed operation/table"""
+    context = f"database_{operation}_{table}" if table else f"database_{operation}"
+    
+    return functools.partial(
+        error_handler.handle_error,
+        context=context,
+        level=ErrorLevel.HIGH,
+        user_message="Database operation failed. Please try again.",
+        additional_data={"operation": operation, "table": table}
+    )
\ No newline at end of file
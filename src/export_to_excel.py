@@ -10,17 +10,21 @@ Author: naholav
 """
 
 import os
+import re
 import sys
+import zipfile
 import pandas as pd
 from datetime import datetime
-from sqlalchemy import create_engine
+from functools import lru_cache
+from xml.sax.saxutils import escape
+from sqlalchemy import create_engine, event, select
 from sqlalchemy.orm import sessionmaker
 import logging
 
 # Add parent directory to path to import database models
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from src.database_models import RawData
+from src.database_models import RawData, TrainingData, UserVotes, UserAnalytics, SystemMetrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,53 +35,188 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, 'university_bot.db')}"
 EXCEL_DIR = os.path.join(BASE_DIR, 'excel')
 
+# Derived columns kept only to speed up similarity scans; not part of the export
+CACHE_COLUMNS = {'question_clean', 'answer_clean', 'answer_simhash'}
+
+# Rows fetched and written per batch when streaming a table into a sheet
+EXPORT_CHUNK_SIZE = 1000
+
+# FAST_XLSX=1 writes the workbook XML by hand instead of going through pandas/xlsxwriter
+FAST_XLSX = os.getenv('FAST_XLSX') == '1'
+
+# Control characters that are not allowed in XML 1.0 text
+ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '{overrides}'
+    '</Types>'
+)
+XLSX_SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{index}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets>'
+    '</workbook>'
+)
+XLSX_WORKBOOK_SHEET = '<sheet name="{name}" sheetId="{index}" r:id="rId{index}"/>'
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{relationships}'
+    '</Relationships>'
+)
+XLSX_WORKBOOK_REL = (
+    '<Relationship Id="rId{index}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet{index}.xml"/>'
+)
+XLSX_SHEET_HEAD = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+XLSX_SHEET_TAIL = b'</sheetData></worksheet>'
+
+# One engine per process; the export only reads, so connections run without
+# BEGIN/COMMIT and SQLite is told to refuse writes
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    isolation_level="AUTOCOMMIT",
+    connect_args={"check_same_thread": False}
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine, "connect")
+def configure_export_connection(dbapi_connection, connection_record):
+    """Tune each new SQLite connection for read-only bulk scans."""
+    # WAL is persistent and already enabled by init_db, so readers never block the
+    # bot; it cannot be switched on from a query_only connection anyway
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=1")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # read pages through a 256 MiB memory map
+    cursor.close()
+
 def get_database_connection():
-    """Create database connection and session."""
+    """Return the shared engine and a new session."""
     try:
-        engine = create_engine(DATABASE_URL, echo=False)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
         return engine, SessionLocal()
     except Exception as e:
         logger.error(f"Database connection failed: {e}")
         raise
 
+@lru_cache(maxsize=None)
+def export_columns(model):
+    """Columns of a model's table to export, in declaration order, without similarity cache columns."""
+    return tuple(column for column in model.__table__.columns if column.key not in CACHE_COLUMNS)
+
+def export_table(db_session, model):
+    """Read a whole table into a DataFrame in one query, bypassing ORM objects."""
+    query = select(*export_columns(model))
+    return pd.read_sql_query(query, db_session.get_bind())
+
+def iter_export_table(db_session, model, chunksize=EXPORT_CHUNK_SIZE):
+    """Stream a table as DataFrame chunks so only one batch of rows is held at a time."""
+    query = select(*export_columns(model))
+    connection = db_session.connection(execution_options={'stream_results': True})
+    yield from pd.read_sql_query(query, connection, chunksize=chunksize)
+
+def iter_export_rows(db_session, model, chunksize=EXPORT_CHUNK_SIZE):
+    """Stream a table as batches of plain row tuples straight from the Core result."""
+    query = select(*export_columns(model))
+    connection = db_session.connection(execution_options={'stream_results': True})
+    yield from connection.execute(query).partitions(chunksize)
+
+def xlsx_cell(value):
+    """Render one value as an inline XLSX cell."""
+    if value is None or value != value:  # None, NaN and NaT
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    text = escape(ILLEGAL_XML_CHARS.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def xlsx_rows(rows):
+    """Render an iterable of row tuples as encoded <row> elements."""
+    return ''.join(f"<row>{''.join(map(xlsx_cell, row))}</row>" for row in rows).encode('utf-8')
+
+def write_fast_xlsx(filepath, sheets):
+    """Write a minimal XLSX workbook by streaming sheet XML straight into the zip.
+
+    sheets is a list of (sheet name, iterable of row-tuple batches); each sheet's
+    batches are consumed only when that sheet is written, in list order.
+    """
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for index, (_, batches) in enumerate(sheets, start=1):
+            with zf.open(f'xl/worksheets/sheet{index}.xml', 'w') as sheet:
+                sheet.write(XLSX_SHEET_HEAD)
+                for rows in batches:
+                    sheet.write(xlsx_rows(rows))
+                sheet.write(XLSX_SHEET_TAIL)
+
+        indexes = range(1, len(sheets) + 1)
+        zf.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES.format(
+            overrides=''.join(XLSX_SHEET_CONTENT_TYPE.format(index=index) for index in indexes)))
+        zf.writestr('_rels/.rels', XLSX_ROOT_RELS)
+        zf.writestr('xl/workbook.xml', XLSX_WORKBOOK.format(sheets=''.join(
+            XLSX_WORKBOOK_SHEET.format(name=escape(name), index=index)
+            for index, (name, _) in zip(indexes, sheets))))
+        zf.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS.format(
+            relationships=''.join(XLSX_WORKBOOK_REL.format(index=index) for index in indexes)))
+
+def build_export_summary(raw_data_count, exported_at):
+    """Rows of the summary sheet: export information, a blank row, then the table summary."""
+    return [
+        ('Export Information', 'Values'),
+        ('Export Date', exported_at.strftime("%Y-%m-%d")),
+        ('Export Time', exported_at.strftime("%H:%M:%S")),
+        ('Database File', 'university_bot.db'),
+        ('Tables Exported', 'raw_data only'),
+        (),
+        ('Table Name', 'Record Count', 'Description'),
+        ('raw_data', raw_data_count, 'User interactions and questions'),
+    ]
+
+def export_fast_xlsx(filepath, db_session, exported_at):
+    """Export raw_data and the summary sheet through write_fast_xlsx; returns the raw_data row count."""
+    raw_data_count = 0
+
+    def raw_data_batches():
+        nonlocal raw_data_count
+        yield [tuple(column.key for column in export_columns(RawData))]
+        for rows in iter_export_rows(db_session, RawData):
+            yield rows
+            raw_data_count += len(rows)
+
+    def summary_batches():
+        # Runs after raw_data has been written, so the record count is final
+        yield build_export_summary(raw_data_count, exported_at)
+
+    write_fast_xlsx(filepath, [('raw_data', raw_data_batches()), ('export_summary', summary_batches())])
+    return raw_data_count
+
 def export_raw_data(db_session):
     """Export raw_data table to DataFrame."""
     try:
-        query = db_session.query(RawData)
-        data = []
-        
-        for record in query.all():
-            data.append({
-                'id': record.id,
-                'telegram_id': record.telegram_id,
-                'telegram_message_id': record.telegram_message_id,
-                'username': record.username,
-                'question': record.question,
-                'answer': record.answer,
-                'language': record.language,
-                'like': record.like,
-                'admin_approved': record.admin_approved,
-                'is_duplicate': record.is_duplicate,
-                'duplicate_of_id': record.duplicate_of_id,
-                'similarity_score': record.similarity_score,
-                'created_at': record.created_at,
-                'answered_at': record.answered_at,
-                'message_thread_id': record.message_thread_id,
-                'processing_time': record.processing_time,
-                'model_version': record.model_version,
-                'context_length': record.context_length,
-                'response_length': record.response_length,
-                'quality_score': record.quality_score,
-                'sentiment_score': record.sentiment_score,
-                'complexity_score': record.complexity_score,
-                'topic_category': record.topic_category,
-                'keywords': record.keywords,
-                'admin_notes': record.admin_notes,
-                'last_updated': record.last_updated
-            })
-        
-        return pd.DataFrame(data)
+        return export_table(db_session, RawData)
     except Exception as e:
         logger.error(f"Error exporting raw_data: {e}")
         return pd.DataFrame()
@@ -85,40 +224,7 @@ def export_raw_data(db_session):
 def export_training_data(db_session):
     """Export training_data table to DataFrame."""
     try:
-        query = db_session.query(TrainingData)
-        data = []
-        
-        for record in query.all():
-            data.append({
-                'id': record.id,
-                'source_id': record.source_id,
-                'question': record.question,
-                'answer': record.answer,
-                'language': record.language,
-                'is_answer_duplicate': record.is_answer_duplicate,
-                'duplicate_answer_of_id': record.duplicate_answer_of_id,
-                'answer_similarity_score': record.answer_similarity_score,
-                'quality_score': record.quality_score,
-                'usage_count': record.usage_count,
-                'effectiveness_score': record.effectiveness_score,
-                'category': record.category,
-                'difficulty_level': record.difficulty_level,
-                'topic_tags': record.topic_tags,
-                'training_weight': record.training_weight,
-                'augmentation_count': record.augmentation_count,
-                'source_type': record.source_type,
-                'review_status': record.review_status,
-                'reviewer_id': record.reviewer_id,
-                'review_date': record.review_date,
-                'admin_notes': record.admin_notes,
-                'version': record.version,
-                'is_active': record.is_active,
-                'created_at': record.created_at,
-                'last_used_at': record.last_used_at,
-                'last_updated': record.last_updated
-            })
-        
-        return pd.DataFrame(data)
+        return export_table(db_session, TrainingData)
     except Exception as e:
         logger.error(f"Error exporting training_data: {e}")
         return pd.DataFrame()
@@ -126,22 +232,7 @@ def export_training_data(db_session):
 def export_user_votes(db_session):
     """Export user_votes table to DataFrame."""
     try:
-        query = db_session.query(UserVotes)
-        data = []
-        
-        for record in query.all():
-            data.append({
-                'id': record.id,
-                'raw_data_id': record.raw_data_id,
-                'telegram_user_id': record.telegram_user_id,
-                'current_vote': record.current_vote,
-                'vote_changes_count': record.vote_changes_count,
-                'first_vote_at': record.first_vote_at,
-                'last_vote_at': record.last_vote_at,
-                'created_at': record.created_at
-            })
-        
-        return pd.DataFrame(data)
+        return export_table(db_session, UserVotes)
     except Exception as e:
         logger.error(f"Error exporting user_votes: {e}")
         return pd.DataFrame()
@@ -149,30 +240,7 @@ def export_user_votes(db_session):
 def export_user_analytics(db_session):
     """Export user_analytics table to DataFrame."""
     try:
-        query = db_session.query(UserAnalytics)
-        data = []
-        
-        for record in query.all():
-            data.append({
-                'id': record.id,
-                'telegram_id': record.telegram_id,
-                'session_count': record.session_count,
-                'total_questions': record.total_questions,
-                'total_likes': record.total_likes,
-                'total_dislikes': record.total_dislikes,
-                'preferred_language': record.preferred_language,
-                'most_active_hour': record.most_active_hour,
-                'avg_session_duration': record.avg_session_duration,
-                'avg_satisfaction': record.avg_satisfaction,
-                'engagement_score': record.engagement_score,
-                'retention_score': record.retention_score,
-                'first_interaction': record.first_interaction,
-                'last_interaction': record.last_interaction,
-                'created_at': record.created_at,
-                'updated_at': record.updated_at
-            })
-        
-        return pd.DataFrame(data)
+        return export_table(db_session, UserAnalytics)
     except Exception as e:
         logger.error(f"Error exporting user_analytics: {e}")
         return pd.DataFrame()
@@ -180,23 +248,7 @@ def export_user_analytics(db_session):
 def export_system_metrics(db_session):
     """Export system_metrics table to DataFrame."""
     try:
-        query = db_session.query(SystemMetrics)
-        data = []
-        
-        for record in query.all():
-            data.append({
-                'id': record.id,
-                'metric_name': record.metric_name,
-                'metric_value': record.metric_value,
-                'metric_type': record.metric_type,
-                'service_name': record.service_name,
-                'instance_id': record.instance_id,
-                'tags': record.tags,
-                'timestamp': record.timestamp,
-                'details': record.details
-            })
-        
-        return pd.DataFrame(data)
+        return export_table(db_session, SystemMetrics)
     except Exception as e:
         logger.error(f"Error exporting system_metrics: {e}")
         return pd.DataFrame()
@@ -210,61 +262,59 @@ def main():
         # Get database connection
         engine, db_session = get_database_connection()
         
-        # Generate timestamp for filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Generate timestamp for filename; the summary sheet reuses the same instant
+        exported_at = datetime.now()
+        timestamp = exported_at.strftime("%Y%m%d_%H%M%S")
         filename = f"cengbot_database_export_{timestamp}.xlsx"
         filepath = os.path.join(EXCEL_DIR, filename)
         
         logger.info(f"Starting database export to {filepath}")
         
-        # Create Excel writer
-        with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-            # Export ONLY raw_data table
-            logger.info("Exporting raw_data table...")
-            raw_data_df = export_raw_data(db_session)
-            if not raw_data_df.empty:
-                raw_data_df.to_excel(writer, sheet_name='raw_data', index=False)
-                logger.info(f"Exported {len(raw_data_df)} raw_data records")
-            else:
-                logger.warning("No raw_data records found to export")
-            
-            # Create summary sheet
-            summary_data = {
-                'Export Information': ['Export Date', 'Export Time', 'Database File', 'Tables Exported'],
-                'Values': [
-                    datetime.now().strftime("%Y-%m-%d"),
-                    datetime.now().strftime("%H:%M:%S"),
-                    'university_bot.db',
-                    'raw_data only'
-                ]
-            }
-            
-            table_summary = {
-                'Table Name': ['raw_data'],
-                'Record Count': [len(raw_data_df)],
-                'Description': ['User interactions and questions']
-            }
-            
-            summary_df = pd.DataFrame(summary_data)
-            table_summary_df = pd.DataFrame(table_summary)
+        if FAST_XLSX:
+            logger.info("Exporting raw_data table (FAST_XLSX)...")
+            raw_data_count = export_fast_xlsx(filepath, db_session, exported_at)
+            logger.info(f"Exported {raw_data_count} raw_data records")
+        else:
+            # Create Excel writer (xlsxwriter streams cells out instead of building an
+            # openpyxl cell tree; constant_memory is not usable because pandas writes
+            # each chunk column by column)
+            with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
+                # Export ONLY raw_data table
+                logger.info("Exporting raw_data table...")
+                raw_data_count = 0
+                for chunk in iter_export_table(db_session, RawData):
+                    chunk.to_excel(
+                        writer,
+                        sheet_name='raw_data',
+                        index=False,
+                        header=raw_data_count == 0,
+                        startrow=raw_data_count + 1 if raw_data_count else 0
+                    )
+                    raw_data_count += len(chunk)
+                if raw_data_count:
+                    logger.info(f"Exported {raw_data_count} raw_data records")
+                else:
+                    logger.warning("No raw_data records found to export")
             
-            # Write summary to first sheet
-            summary_df.to_excel(writer, sheet_name='export_summary', index=False, startrow=0)
-            table_summary_df.to_excel(writer, sheet_name='export_summary', index=False, startrow=6)
+                # Create summary sheet; a dozen cells are written directly rather
+                # than through two DataFrame.to_excel calls
+                summary_sheet = writer.book.add_worksheet('export_summary')
+                for row_index, row in enumerate(build_export_summary(raw_data_count, exported_at)):
+                    summary_sheet.write_row(row_index, 0, row)
             
-            logger.info("Summary sheet created")
+                logger.info("Summary sheet created")
         
         # Close database session
         db_session.close()
         
         logger.info(f"✅ Raw database export completed successfully!")
         logger.info(f"📁 File saved: {filepath}")
-        logger.info(f"📊 Total records exported: {len(raw_data_df)}")
+        logger.info(f"📊 Total records exported: {raw_data_count}")
         
         print(f"✅ Raw database export completed successfully!")
         print(f"📁 File: {filename}")
         print(f"📍 Location: {filepath}")
-        print(f"📊 Records: {len(raw_data_df)} raw_data entries")
+        print(f"📊 Records: {raw_data_count} raw_data entries")
         
         return True
         
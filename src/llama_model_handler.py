@@ -1,10 +1,20 @@
 import os
+import re
+import importlib.util
+import copy
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import torch
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
-    GenerationConfig
+    DynamicCache,
+    GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList
 )
 from peft import PeftModel
 import logging
@@ -16,6 +26,28 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Token budget for the whole prompt (the user message is truncated to fit)
+MAX_PROMPT_TOKENS = 512
+
+# Replies are cut to this many sentences, with at most one question among them
+MAX_RESPONSE_SENTENCES = 3
+# Shortest run of text ending in sentence punctuation followed by whitespace, or the rest of the text
+SENTENCE_RE = re.compile(r'.+?(?:[.!?]+(?=\s|\Z)|\Z)', re.S)
+# Turkish question particles, for questions written without a question mark
+TURKISH_QUESTION_RE = re.compile(r'\bm[ıiuü]\b', re.I)
+
+# Language detection: Turkish-only letters or common Turkish words settle it without langdetect
+TURKISH_CHARS_RE = re.compile(r'[çğıöşüÇĞİÖŞÜ]')
+TURKISH_WORDS_RE = re.compile(r'\b(?:merhaba|selam|nedir|nas[ıi]l|hangi|var|m[ıiuü])\b', re.I)
+
+# Greetings get a short reply; matched as whole words / word pairs of the message
+WORD_RE = re.compile(r'\w+')
+GREETING_WORDS = frozenset({'selam', 'merhaba', 'hey', 'slm', 'mrb', 'günaydın', 'hello', 'hi', 'greetings'})
+GREETING_PHRASES = frozenset({
+    ('iyi', 'günler'), ('iyi', 'akşamlar'),
+    ('good', 'morning'), ('good', 'afternoon'), ('good', 'evening')
+})
+
 class ModelConfig:
     # Model paths - Updated for active model system
     base_model = "meta-llama/Llama-3.2-3B"
@@ -23,6 +55,18 @@ class ModelConfig:
     cache_dir = "model_cache"
     use_local_cache = True
     
+    # Load the base model as NF4 4-bit weights (bitsandbytes, CUDA only); opt-in
+    # because the LoRA was trained on bf16 weights and NF4 changes its outputs
+    load_in_4bit = os.getenv("LOAD_IN_4BIT", "0") == "1"
+    
+    # Compile the (merged, bf16) model forward with torch.compile; opt-in because
+    # the first requests pay the compilation time
+    compile_model = os.getenv("COMPILE_MODEL", "0") == "1"
+    
+    # Dynamic batching: concurrent requests arriving within batch_wait_ms share one generate() call
+    batch_max_size = 8
+    batch_wait_ms = 20
+    
     # Generation parameters - AYNEN KORUNDU
     temperature = 0.7
     max_new_tokens = 200
@@ -56,35 +100,42 @@ Important rules:
     # HuggingFace token
     hf_token = os.getenv("HUGGING_FACE_TOKEN")
 
+class StopOnTokens(StoppingCriteria):
+    """Finish each sequence once it ends with one of the given token id sequences"""
+    def __init__(self, stop_sequences: list):
+        self.stop_sequences = stop_sequences
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for stop_ids in self.stop_sequences:
+            if input_ids.shape[1] >= stop_ids.shape[0]:
+                done |= (input_ids[:, -stop_ids.shape[0]:] == stop_ids).all(dim=1)
+        return done
+
 class CengBotModel:
     def __init__(self):
         self.model = None
         self.tokenizer = None
+        self.prefix_ids = {}  # language -> tokenized system prompt + "Student:"
+        self.suffix_ids = None  # tokenized "\nAssistant:"
+        self.prefix_cache = {}  # language -> KV cache of prefix_ids
+        self.stopping_criteria = None  # stops a reply when the model starts a "Student:" turn
+        self.request_queue = queue.Queue()  # (message, Future) pairs for batch_worker
+        self.batch_thread = None
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.input_device = self.device  # device of the input embeddings, set once the model is dispatched
         self.config = ModelConfig()
         logger.info(f"Using device: {self.device}")
         
     def detect_language(self, text: str) -> str:
         """Detect the language of the input text"""
+        if TURKISH_CHARS_RE.search(text) or TURKISH_WORDS_RE.search(text):
+            return 'tr'
+        
+        clean_text = text.strip().lower()
         try:
-            clean_text = text.strip().lower()
-            
-            # Quick check for common Turkish characters
-            turkish_chars = ['ç', 'ğ', 'ı', 'ö', 'ş', 'ü']
-            if any(char in clean_text for char in turkish_chars):
-                return 'tr'
-            
-            detected_lang = detect(clean_text)
-            
-            if detected_lang == 'tr':
-                return 'tr'
-            else:
-                return 'en'
-                
+            return 'tr' if detect(clean_text) == 'tr' else 'en'
         except LangDetectException:
-            turkish_words = ['merhaba', 'selam', 'nedir', 'nasıl', 'hangi', 'var', 'mı', 'mi', 'mu', 'mü']
-            if any(word in text.lower() for word in turkish_words):
-                return 'tr'
             return 'en'
     
     def load_model(self):
@@ -106,11 +157,40 @@ class CengBotModel:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             self.tokenizer.padding_side = "left"
             
+            # Tokenize the fixed system prompt prefixes once; only the user turn is
+            # tokenized per request. The space before the message stays with the
+            # user turn so its first word tokenizes as it would in the full prompt.
+            self.prefix_ids = {
+                lang: self.tokenizer(f"{system_prompt}\n\nStudent:", return_tensors="pt").input_ids
+                for lang, system_prompt in (('tr', self.config.system_prompt_tr), ('en', self.config.system_prompt_en))
+            }
+            self.suffix_ids = self.tokenizer("\nAssistant:", add_special_tokens=False).input_ids
+            
             # Load base model
             logger.info("Loading base model...")
+            quantization_config = None
+            if self.config.load_in_4bit and torch.cuda.is_available():
+                # NF4 weights are ~4x smaller than bf16, so each decode step reads far less memory
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                    bnb_4bit_use_double_quant=True
+                )
+                logger.info("Using NF4 4-bit quantization")
+            
+            # Fused Flash-Attention 2 kernels when the flash-attn package is installed,
+            # PyTorch's scaled_dot_product_attention otherwise
+            if torch.cuda.is_available() and importlib.util.find_spec("flash_attn") is not None:
+                attn_implementation = "flash_attention_2"
+            else:
+                attn_implementation = "sdpa"
+            logger.info(f"Attention implementation: {attn_implementation}")
             base_model = AutoModelForCausalLM.from_pretrained(
                 self.config.base_model,
-                torch_dtype=torch.bfloat16,
+                quantization_config=quantization_config,
+                torch_dtype=torch.bfloat16,  # non-quantized layers (norms, embeddings) stay bf16
+                attn_implementation=attn_implementation,
                 device_map="auto",
                 token=self.config.hf_token,
                 trust_remote_code=True,
@@ -145,7 +225,47 @@ class CengBotModel:
             )
             logger.info("✅ LoRA adapter loaded successfully!")
             
+            # Fold the LoRA deltas into the base weights so each forward skips the
+            # adapter side branch. NF4 weights are left unmerged: merging would
+            # re-round the updated weights back to 4 bits and lose the fine-tuning.
+            if quantization_config is None:
+                self.model = self.model.merge_and_unload()
+                logger.info("LoRA adapter merged into base weights")
+            
             self.model.eval()
+            
+            # With device_map="auto" the layers may be spread over several devices;
+            # inputs belong on the device holding the input embeddings
+            self.input_device = self.model.get_input_embeddings().weight.device
+            self.prefix_ids = {lang: prefix_ids.to(self.input_device) for lang, prefix_ids in self.prefix_ids.items()}
+            
+            # Stop generating as soon as the model starts a fake next "Student:" turn
+            # (with and without a leading space, which tokenize differently)
+            self.stopping_criteria = StoppingCriteriaList([StopOnTokens([
+                torch.tensor(self.tokenizer.encode(stop, add_special_tokens=False), device=self.input_device)
+                for stop in ("Student:", " Student:")
+            ])])
+            
+            # Fuse the decode step's small kernels. Only for the merged bf16 model:
+            # bitsandbytes 4-bit layers break the graph. Shapes are left dynamic
+            # because the KV cache grows by one position every decode step.
+            if self.config.compile_model and quantization_config is None:
+                torch.set_float32_matmul_precision('high')
+                self.model.forward = torch.compile(self.model.forward, dynamic=True)
+                logger.info("Model forward compiled with torch.compile")
+            
+            # Prefill the system prompt prefixes once so generation only has to
+            # run attention over the message tokens
+            with torch.no_grad():
+                self.prefix_cache = {
+                    lang: self.model(prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+                    for lang, prefix_ids in self.prefix_ids.items()
+                }
+            
+            # Background worker that serves generate_response calls in batches
+            if self.batch_thread is None:
+                self.batch_thread = threading.Thread(target=self.batch_worker, name="generation-batcher", daemon=True)
+                self.batch_thread.start()
             logger.info("🎉 LLaMA 3.2 3B + LoRA model loaded successfully!")
             return True
             
@@ -154,112 +274,156 @@ class CengBotModel:
             logger.error(f"Failed to load model: {e}")
             return False
     
-    def format_prompt(self, message: str) -> tuple:
-        """Format the prompt with system prompt based on detected language"""
-        lang = self.detect_language(message)
-        logger.info(f"Detected language: {lang}")
-        
-        if lang == 'tr':
-            system_prompt = self.config.system_prompt_tr
-            formatted_prompt = f"{system_prompt}\n\nStudent: {message}\nAssistant:"
-        else:
-            system_prompt = self.config.system_prompt_en
-            formatted_prompt = f"{system_prompt}\n\nStudent: {message}\nAssistant:"
-        
-        return formatted_prompt, lang
-    
     def generate_response(self, message: str):
         """Generate response from the model"""
         if self.model is None:
             return "Model not loaded."
         
-        try:
-            # Format prompt and get language
-            prompt, lang = self.format_prompt(message)
-            
-            # Tokenize
-            inputs = self.tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=512,
-                padding=True
-            ).to(self.device)
-            
-            # Check if it's a greeting
-            greetings_tr = ["selam", "merhaba", "hey", "slm", "mrb", "günaydın", "iyi günler", "iyi akşamlar"]
-            greetings_en = ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "greetings"]
-            
-            is_greeting = any(greeting in message.lower() for greeting in (greetings_tr + greetings_en))
+        # Hand the request to the batching worker and wait for its reply
+        future = Future()
+        self.request_queue.put((message, future))
+        return future.result()
+    
+    def prepare_request(self, message: str) -> tuple:
+        """Detect language, token limit and user token ids for a message"""
+        lang = self.detect_language(message)
+        logger.info(f"Detected language: {lang}")
+        
+        # Tokenize only the message and wrap it in the cached prompt pieces
+        user_ids = self.tokenizer(
+            f" {message}",
+            add_special_tokens=False,
+            truncation=True,
+            max_length=MAX_PROMPT_TOKENS - self.prefix_ids[lang].shape[1] - len(self.suffix_ids)
+        ).input_ids + self.suffix_ids
+        
+        # Check if it's a greeting
+        words = WORD_RE.findall(message.lower())
+        is_greeting = not GREETING_WORDS.isdisjoint(words) or not GREETING_PHRASES.isdisjoint(zip(words, words[1:]))
+        
+        # Adjust max tokens for greetings
+        max_tokens = 30 if is_greeting else 100
+        
+        return lang, max_tokens, user_ids
+    
+    def batch_worker(self):
+        """Collect requests arriving within batch_wait_ms and generate them together"""
+        while True:
+            batch = [self.request_queue.get()]
+            deadline = time.monotonic() + self.config.batch_wait_ms / 1000
+            while len(batch) < self.config.batch_max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.request_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
             
-            # Adjust max tokens for greetings
-            max_tokens = 30 if is_greeting else 100
+            # Requests sharing a prompt prefix and token limit run as one generate() call
+            groups = {}
+            for message, future in batch:
+                try:
+                    lang, max_tokens, user_ids = self.prepare_request(message)
+                    groups.setdefault((lang, max_tokens), []).append((user_ids, future))
+                except Exception as e:
+                    future.set_result(self.generation_error(e))
             
-            # Create generation config
-            generation_config = GenerationConfig(
-                temperature=self.config.temperature,
-                max_new_tokens=max_tokens,
-                repetition_penalty=self.config.repetition_penalty,
-                top_p=self.config.top_p,
-                top_k=self.config.top_k,
-                do_sample=True,
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
+            for (lang, max_tokens), requests in groups.items():
+                try:
+                    responses = self.generate_batch(lang, max_tokens, [user_ids for user_ids, _ in requests])
+                except Exception as e:
+                    responses = [self.generation_error(e)] * len(requests)
+                for (_, future), response in zip(requests, responses):
+                    future.set_result(response)
+    
+    def generate_batch(self, lang: str, max_tokens: int, user_ids_batch: list) -> list:
+        """Generate replies for tokenized messages that share the same language prefix"""
+        batch_size = len(user_ids_batch)
+        prefix_ids = self.prefix_ids[lang]
+        user_length = max(len(user_ids) for user_ids in user_ids_batch)
+        
+        # Left-pad the user turns between the shared prefix and the reply; padding
+        # is masked out and skipped when generate() derives the position ids
+        user_block = torch.full((batch_size, user_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        user_mask = torch.zeros((batch_size, user_length), dtype=torch.long)
+        for row, user_ids in enumerate(user_ids_batch):
+            user_block[row, user_length - len(user_ids):] = torch.tensor(user_ids)
+            user_mask[row, user_length - len(user_ids):] = 1
+        if self.input_device.type == 'cuda':
+            user_block = user_block.pin_memory()
+            user_mask = user_mask.pin_memory()
+        user_block = user_block.to(self.input_device, non_blocking=True)
+        user_mask = user_mask.to(self.input_device, non_blocking=True)
+        input_ids = torch.cat([prefix_ids.expand(batch_size, -1), user_block], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids).expand(batch_size, -1), user_mask], dim=1)
+        
+        # generate() extends the cache in place, so each batch gets its own copy
+        past_key_values = copy.deepcopy(self.prefix_cache[lang])
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        
+        # Create generation config
+        generation_config = GenerationConfig(
+            temperature=self.config.temperature,
+            max_new_tokens=max_tokens,
+            repetition_penalty=self.config.repetition_penalty,
+            top_p=self.config.top_p,
+            top_k=self.config.top_k,
+            do_sample=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+        )
+        
+        # Generate
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                generation_config=generation_config,
+                stopping_criteria=self.stopping_criteria
             )
-            
-            # Generate
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    generation_config=generation_config
-                )
-            
-            # Decode response
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            # Extract only the assistant's response
-            if lang == 'tr':
-                if "Assistant:" in response:
-                    response = response.split("Assistant:")[-1].strip()
-                    if "Student:" in response:
-                        response = response.split("Student:")[0].strip()
-            else:
-                if "Assistant:" in response:
-                    response = response.split("Assistant:")[-1].strip()
-                    if "Student:" in response:
-                        response = response.split("Student:")[0].strip()
-            
-            # Limit to 3 sentences
-            sentences = response.split('. ')
-            if len(sentences) > 3:
-                sentences = sentences[:3]
-            response = '. '.join(sentences)
-            
-            # Count question marks and limit to 1
-            question_count = response.count('?')
-            if question_count > 1:
-                parts = response.split('?')
-                response = parts[0] + '?'
-                for part in parts[1:]:
-                    if part.strip() and '?' not in part:
-                        if lang == 'tr':
-                            if not any(q in part.lower() for q in ['mı', 'mi', 'mu', 'mü']):
-                                response += ' ' + part.strip() + '.'
-                                break
-                        else:
-                            response += ' ' + part.strip() + '.'
-                            break
-            
-            # Ensure it ends with proper punctuation
-            if response and not response.endswith(('.', '!', '?')):
-                response += '.'
-            
-            return response
-            
-        except Exception as e:
-            error_response = handle_model_error(e, "generate_response")
-            logger.error(f"Generation error: {e}")
-            return "Sorry, I encountered an error while generating a response. Please try again."
+        
+        # Decode only the generated tokens; the prompt is never turned back into text
+        responses = self.tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        return [self.postprocess_response(response, lang) for response in responses]
+    
+    def generation_error(self, error: Exception) -> str:
+        """Log a generation failure and return the fallback reply"""
+        error_response = handle_model_error(error, "generate_response")
+        logger.error(f"Generation error: {error}")
+        return "Sorry, I encountered an error while generating a response. Please try again."
+
+    def postprocess_response(self, response: str, lang: str) -> str:
+        """Cut the generated text down to the assistant's reply and apply the length rules"""
+        # Drop the "Student:" that triggered the stopping criteria
+        end = response.find("Student:")
+        if end != -1:
+            response = response[:end]
+        
+        # Single pass over the sentences: stop after the limit, drop extra questions
+        sentences = []
+        has_question = False
+        for match in SENTENCE_RE.finditer(response):
+            sentence = match.group().strip()
+            if not sentence:
+                continue
+            is_question = sentence.endswith('?') or (lang == 'tr' and TURKISH_QUESTION_RE.search(sentence) is not None)
+            if is_question:
+                if has_question:
+                    continue
+                has_question = True
+            sentences.append(sentence)
+            if len(sentences) == MAX_RESPONSE_SENTENCES:
+                break
+        response = ' '.join(sentences)
+        
+        # Ensure it ends with proper punctuation
+        if response and not response.endswith(('.', '!', '?')):
+            response += '.'
+        
+        return response
 
 # Global model instance
 model_instance = CengBotModel()
\ No newline at end of file
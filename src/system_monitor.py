@@ -5,23 +5,82 @@ System monitoring and logging for CengBot
 
 import os
 import time
+import shutil
 import json
+import heapq
+import operator
 import psutil
+import queue
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional
 from pathlib import Path
 import threading
 import signal
 import sys
 
+# Optional fast JSON serialization
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Optional NVML bindings (nvidia-ml-py) for GPU memory; unlike torch.cuda they
+# read the driver's figures without creating a CUDA context on the watched card
+try:
+    import pynvml
+    NVML_AVAILABLE = True
+except ImportError:
+    NVML_AVAILABLE = False
+
 # Database imports
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import scoped_session
 from database_models import SessionLocal, RawData, TrainingData
 
-@dataclass
-class SystemMetrics:
-    """System metrics data structure"""
+# Thread-local session reused by every metrics tick instead of building a new one
+MetricsSession = scoped_session(SessionLocal)
+
+# cpu_percent() readings closer together than this reuse the previous value
+CPU_SAMPLE_MIN_INTERVAL = 1.0
+# Disk usage changes slowly; statvfs is re-read at most this often (seconds)
+DISK_USAGE_TTL = 30.0
+# Default period of the background system sampler, independent of log_interval
+SYSTEM_SAMPLE_INTERVAL = 10.0
+
+# Background log writer: buffer size per file and flush cadence
+LOG_WRITE_BUFFER_SIZE = 64 * 1024
+LOG_FLUSH_EVERY = 64  # entries
+
+# Alert types that get the top processes attached, and the field they are ranked by
+PROCESS_ALERT_KEYS = {"cpu_high": "cpu_percent", "memory_high": "memory_percent"}
+
+# Field layout of an alert log entry; check_alerts fills in a copy per alert
+ALERT_TEMPLATE = {
+    "timestamp": None,
+    "level": "warning",
+    "type": None,
+    "message": None,
+    "value": None,
+    "threshold": None
+}
+
+# Old log entries are trimmed once per this many seconds of uptime
+LOG_CLEANUP_INTERVAL = 24 * 60 * 60
+
+# Queued to the log writer to have it release its handles and run cleanup_old_logs
+CLEANUP_LOGS = object()
+
+def dumps_line(data: Dict) -> bytes:
+    """Serialize a log entry to a newline-terminated JSONL line"""
+    # datetime values are formatted as ISO 8601 here (by orjson in C when available)
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(data, default=datetime.isoformat) + '\n').encode()
+
+class SystemMetrics(NamedTuple):
+    """System metrics data structure (an immutable tuple, no per-instance __dict__)"""
     timestamp: datetime
     cpu_percent: float
     memory_percent: float
@@ -32,21 +91,17 @@ class SystemMetrics:
     gpu_memory_used: Optional[float] = None
     gpu_memory_total: Optional[float] = None
     
+    @property
+    def gpu_memory_percent(self) -> Optional[float]:
+        """Share of device memory in use, from the driver's free/total figures"""
+        if not self.gpu_memory_total:
+            return None
+        return self.gpu_memory_used / self.gpu_memory_total * 100
+    
     def to_dict(self) -> Dict:
-        return {
-            "timestamp": self.timestamp.isoformat(),
-            "cpu_percent": self.cpu_percent,
-            "memory_percent": self.memory_percent,
-            "memory_available_gb": self.memory_available_gb,
-            "disk_usage_percent": self.disk_usage_percent,
-            "disk_free_gb": self.disk_free_gb,
-            "gpu_available": self.gpu_available,
-            "gpu_memory_used": self.gpu_memory_used,
-            "gpu_memory_total": self.gpu_memory_total
-        }
+        return {**self._asdict(), "timestamp": self.timestamp.isoformat()}
 
-@dataclass
-class DatabaseMetrics:
+class DatabaseMetrics(NamedTuple):
     """Database metrics data structure"""
     timestamp: datetime
     raw_data_count: int
@@ -56,23 +111,52 @@ class DatabaseMetrics:
     duplicate_count: int
     
     def to_dict(self) -> Dict:
-        return {
-            "timestamp": self.timestamp.isoformat(),
-            "raw_data_count": self.raw_data_count,
-            "training_data_count": self.training_data_count,
-            "approved_count": self.approved_count,
-            "pending_count": self.pending_count,
-            "duplicate_count": self.duplicate_count
-        }
+        return {**self._asdict(), "timestamp": self.timestamp.isoformat()}
 
 class SystemMonitor:
     """System monitoring and logging class"""
     
-    def __init__(self, log_interval: int = 60, max_log_age_days: int = 30):
+    # Alert rules: (metrics source, attribute, comparison, threshold key, alert type, message format)
+    ALERT_RULES = (
+        ("system", "cpu_percent", operator.gt, "cpu_percent", "cpu_high", "High CPU usage: {:.1f}%"),
+        ("system", "memory_percent", operator.gt, "memory_percent", "memory_high", "High memory usage: {:.1f}%"),
+        ("system", "disk_usage_percent", operator.gt, "disk_usage_percent", "disk_high", "High disk usage: {:.1f}%"),
+        ("system", "disk_free_gb", operator.lt, "disk_free_gb", "disk_low", "Low disk space: {:.1f}GB"),
+        ("system", "gpu_memory_percent", operator.gt, "gpu_memory_percent", "gpu_memory_high", "High GPU memory usage: {:.1f}%"),
+        ("database", "pending_count", operator.gt, "pending_count", "pending_high", "High pending questions: {}"),
+    )
+    
+    def __init__(self, log_interval: int = 60, max_log_age_days: int = 30,
+                 sample_interval: float = SYSTEM_SAMPLE_INTERVAL):
         self.log_interval = log_interval
         self.max_log_age_days = max_log_age_days
+        self.sample_interval = sample_interval
         self.running = False
         self.monitor_thread = None
+        self.sampler_thread = None
+        self.latest_system_metrics = None  # newest snapshot from the sampler thread
+        self.stop_event = threading.Event()  # wakes the monitor loop early on stop()
+        self.log_queue = queue.Queue()  # (path, encoded JSONL line) pairs, None stops the writer
+        self.writer_thread = None
+        
+        # Non-blocking CPU sampling: the first call only sets the baseline
+        psutil.cpu_percent(interval=None)
+        self.last_cpu_sample_time = time.monotonic()
+        self.last_cpu_percent = 0.0
+        
+        # Cached disk usage, refreshed every DISK_USAGE_TTL seconds
+        self.disk_usage = None
+        self.disk_usage_time = 0.0
+        
+        # GPU presence does not change while running; probe it once through NVML
+        self.gpu_handle = None
+        if NVML_AVAILABLE:
+            try:
+                pynvml.nvmlInit()
+                self.gpu_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+            except Exception:
+                self.gpu_handle = None
+        self.gpu_available = self.gpu_handle is not None
         
         # Setup logging
         self.setup_logging()
@@ -92,7 +176,8 @@ class SystemMonitor:
             "memory_percent": 85.0,
             "disk_usage_percent": 90.0,
             "disk_free_gb": 2.0,
-            "gpu_memory_percent": 90.0
+            "gpu_memory_percent": 90.0,
+            "pending_count": 100
         }
         
         self.logger.info("System monitor initialized")
@@ -125,32 +210,37 @@ class SystemMonitor:
             self.logger.addHandler(console_handler)
             self.logger.setLevel(logging.INFO)
     
-    def collect_system_metrics(self) -> SystemMetrics:
+    def collect_system_metrics(self, timestamp: Optional[datetime] = None) -> SystemMetrics:
         """Collect system metrics"""
         try:
-            # CPU and Memory
-            cpu_percent = psutil.cpu_percent(interval=1)
+            # CPU usage since the previous sample (no blocking 1s measurement window)
+            now = time.monotonic()
+            if now - self.last_cpu_sample_time >= CPU_SAMPLE_MIN_INTERVAL:
+                self.last_cpu_percent = psutil.cpu_percent(interval=None)
+                self.last_cpu_sample_time = now
+            cpu_percent = self.last_cpu_percent
+            
+            # Memory and disk
             memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
+            if self.disk_usage is None or now - self.disk_usage_time >= DISK_USAGE_TTL:
+                self.disk_usage = psutil.disk_usage('/')
+                self.disk_usage_time = now
+            disk = self.disk_usage
             
             # GPU metrics
-            gpu_available = False
+            gpu_available = self.gpu_available
             gpu_memory_used = None
             gpu_memory_total = None
             
-            try:
-                import torch
-                if torch.cuda.is_available():
-                    gpu_available = True
-                    # Get GPU memory info
-                    torch.cuda.synchronize()
-                    gpu_memory_used = torch.cuda.memory_allocated(0) / 1024**3  # GB
-                    gpu_memory_total = torch.cuda.max_memory_allocated(0) / 1024**3  # GB
-            except Exception:
-                pass
+            if gpu_available:
+                # Device-wide memory as reported by the driver; reading it does
+                # not need to wait for queued GPU work
+                gpu_memory = pynvml.nvmlDeviceGetMemoryInfo(self.gpu_handle)
+                gpu_memory_used = gpu_memory.used / 1024**3  # GB
+                gpu_memory_total = gpu_memory.total / 1024**3  # GB
             
             return SystemMetrics(
-                timestamp=datetime.now(),
+                timestamp=timestamp or datetime.now(),
                 cpu_percent=cpu_percent,
                 memory_percent=memory.percent,
                 memory_available_gb=memory.available / (1024**3),
@@ -164,21 +254,23 @@ class SystemMonitor:
             self.logger.error(f"Error collecting system metrics: {e}")
             return None
     
-    def collect_database_metrics(self) -> DatabaseMetrics:
+    def collect_database_metrics(self, timestamp: Optional[datetime] = None) -> DatabaseMetrics:
         """Collect database metrics"""
         try:
-            db = SessionLocal()
-            
-            raw_data_count = db.query(RawData).count()
-            training_data_count = db.query(TrainingData).count()
-            approved_count = db.query(RawData).filter(RawData.admin_approved == 1).count()
-            pending_count = db.query(RawData).filter(RawData.admin_approved == 0).count()
-            duplicate_count = db.query(RawData).filter(RawData.is_duplicate == True).count()
-            
-            db.close()
+            with MetricsSession() as db:
+                # One pass over raw_data for all of its counters
+                raw_data_count, approved_count, pending_count, duplicate_count = db.execute(
+                    select(
+                        func.count(RawData.id),
+                        func.coalesce(func.sum(case((RawData.admin_approved == 1, 1), else_=0)), 0),
+                        func.coalesce(func.sum(case((RawData.admin_approved == 0, 1), else_=0)), 0),
+                        func.coalesce(func.sum(case((RawData.is_duplicate == True, 1), else_=0)), 0)
+                    )
+                ).one()
+                training_data_count = db.scalar(select(func.count(TrainingData.id)))
             
             return DatabaseMetrics(
-                timestamp=datetime.now(),
+                timestamp=timestamp or datetime.now(),
                 raw_data_count=raw_data_count,
                 training_data_count=training_data_count,
                 approved_count=approved_count,
@@ -189,77 +281,68 @@ class SystemMonitor:
             self.logger.error(f"Error collecting database metrics: {e}")
             return None
     
-    def check_alerts(self, system_metrics: SystemMetrics, database_metrics: DatabaseMetrics):
+    def check_alerts(self, system_metrics: SystemMetrics, database_metrics: DatabaseMetrics,
+                     timestamp: Optional[datetime] = None):
         """Check for alert conditions"""
         alerts = []
+        metrics_by_source = {"system": system_metrics, "database": database_metrics}
         
-        # System alerts
-        if system_metrics:
-            if system_metrics.cpu_percent > self.alert_thresholds["cpu_percent"]:
-                alerts.append({
-                    "type": "cpu_high",
-                    "message": f"High CPU usage: {system_metrics.cpu_percent:.1f}%",
-                    "value": system_metrics.cpu_percent,
-                    "threshold": self.alert_thresholds["cpu_percent"]
-                })
-            
-            if system_metrics.memory_percent > self.alert_thresholds["memory_percent"]:
-                alerts.append({
-                    "type": "memory_high",
-                    "message": f"High memory usage: {system_metrics.memory_percent:.1f}%",
-                    "value": system_metrics.memory_percent,
-                    "threshold": self.alert_thresholds["memory_percent"]
-                })
-            
-            if system_metrics.disk_usage_percent > self.alert_thresholds["disk_usage_percent"]:
-                alerts.append({
-                    "type": "disk_high",
-                    "message": f"High disk usage: {system_metrics.disk_usage_percent:.1f}%",
-                    "value": system_metrics.disk_usage_percent,
-                    "threshold": self.alert_thresholds["disk_usage_percent"]
-                })
-            
-            if system_metrics.disk_free_gb < self.alert_thresholds["disk_free_gb"]:
-                alerts.append({
-                    "type": "disk_low",
-                    "message": f"Low disk space: {system_metrics.disk_free_gb:.1f}GB",
-                    "value": system_metrics.disk_free_gb,
-                    "threshold": self.alert_thresholds["disk_free_gb"]
-                })
+        for source, attribute, compare, threshold_key, alert_type, message in self.ALERT_RULES:
+            metrics = metrics_by_source[source]
+            if not metrics:
+                continue
+            value = getattr(metrics, attribute)
+            if value is None:
+                continue  # e.g. no GPU
+            threshold = self.alert_thresholds[threshold_key]
+            if compare(value, threshold):
+                alert = ALERT_TEMPLATE.copy()
+                alert["type"] = alert_type
+                alert["message"] = message.format(value)
+                alert["value"] = value
+                alert["threshold"] = threshold
+                alerts.append(alert)
         
-        # Database alerts
-        if database_metrics:
-            if database_metrics.pending_count > 100:
-                alerts.append({
-                    "type": "pending_high",
-                    "message": f"High pending questions: {database_metrics.pending_count}",
-                    "value": database_metrics.pending_count,
-                    "threshold": 100
-                })
+        # Attribute CPU/memory alerts to the heaviest processes; only scanned when one fires
+        for alert in alerts:
+            if alert["type"] in PROCESS_ALERT_KEYS:
+                alert["top_processes"] = self.collect_top_processes(sort_by=PROCESS_ALERT_KEYS[alert["type"]])
         
         # Log alerts
+        if alerts and timestamp is None:
+            timestamp = datetime.now()
         for alert in alerts:
-            alert_data = {
-                "timestamp": datetime.now().isoformat(),
-                "level": "warning",
-                **alert
-            }
-            
-            self.log_alert(alert_data)
+            alert["timestamp"] = timestamp
+            self.log_alert(alert)
             self.logger.warning(f"ALERT: {alert['message']}")
     
+    def collect_top_processes(self, n: int = 5, sort_by: str = "cpu_percent") -> List[Dict]:
+        """Return the n processes using the most CPU or memory"""
+        processes = []
+        for proc in psutil.process_iter(['pid', 'name']):
+            try:
+                # oneshot() reads /proc/<pid> once for all the fields below
+                with proc.oneshot():
+                    processes.append({
+                        "pid": proc.info['pid'],
+                        "name": proc.info['name'],
+                        "cpu_percent": proc.cpu_percent(interval=None),
+                        "memory_percent": round(proc.memory_percent(), 2)
+                    })
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return heapq.nlargest(n, processes, key=lambda process: process[sort_by])
+    
     def log_metrics(self, system_metrics: SystemMetrics, database_metrics: DatabaseMetrics):
         """Log metrics to files"""
         try:
-            # Log system metrics
+            # Log system metrics; dumps_line formats the datetime itself
             if system_metrics:
-                with open(self.system_log_file, 'a') as f:
-                    f.write(json.dumps(system_metrics.to_dict()) + '\\n')
+                self.log_queue.put((self.system_log_file, dumps_line(system_metrics._asdict())))
             
             # Log database metrics
             if database_metrics:
-                with open(self.database_log_file, 'a') as f:
-                    f.write(json.dumps(database_metrics.to_dict()) + '\\n')
+                self.log_queue.put((self.database_log_file, dumps_line(database_metrics._asdict())))
                     
         except Exception as e:
             self.logger.error(f"Error logging metrics: {e}")
@@ -267,43 +350,138 @@ class SystemMonitor:
     def log_alert(self, alert_data: Dict):
         """Log alert to file"""
         try:
-            with open(self.alerts_log_file, 'a') as f:
-                f.write(json.dumps(alert_data) + '\\n')
+            self.log_queue.put((self.alerts_log_file, dumps_line(alert_data)))
         except Exception as e:
             self.logger.error(f"Error logging alert: {e}")
     
+    def writer_loop(self):
+        """Write queued log lines through long-lived buffered file handles"""
+        handles = {}
+        unflushed = 0
+        last_flush = time.monotonic()
+        
+        def flush():
+            for handle in handles.values():
+                handle.flush()
+        
+        try:
+            while True:
+                try:
+                    item = self.log_queue.get(timeout=self.log_interval)
+                except queue.Empty:
+                    item = ()  # idle, only check whether a flush is due
+                if item is None:
+                    break
+                
+                try:
+                    if item is CLEANUP_LOGS:
+                        # Cleanup replaces the files, so close the handles and let
+                        # the next writes reopen the new files
+                        for handle in handles.values():
+                            handle.close()
+                        handles.clear()
+                        unflushed = 0
+                        self.cleanup_old_logs()
+                    elif item:
+                        path, line = item
+                        handle = handles.get(path)
+                        if handle is None:
+                            handle = handles[path] = open(path, 'ab', buffering=LOG_WRITE_BUFFER_SIZE)
+                        handle.write(line)
+                        unflushed += 1
+                    
+                    # Flush every LOG_FLUSH_EVERY entries or once per log interval
+                    if unflushed and (unflushed >= LOG_FLUSH_EVERY or time.monotonic() - last_flush >= self.log_interval):
+                        flush()
+                        unflushed = 0
+                        last_flush = time.monotonic()
+                except Exception as e:
+                    self.logger.error(f"Error writing logs: {e}")
+        finally:
+            for handle in handles.values():
+                handle.close()
+    
     def cleanup_old_logs(self):
         """Clean up old log files"""
         try:
             cutoff_date = datetime.now() - timedelta(days=self.max_log_age_days)
             
-            # Clean up monitoring logs
+            # Clean up monitoring logs. Entries are appended in time order, so the
+            # old ones form a prefix: find where it ends and copy only the tail.
             for log_file in [self.system_log_file, self.database_log_file, self.alerts_log_file]:
                 if log_file.exists():
-                    # Read file and filter out old entries
-                    new_lines = []
-                    with open(log_file, 'r') as f:
-                        for line in f:
-                            try:
-                                data = json.loads(line.strip())
-                                timestamp = datetime.fromisoformat(data['timestamp'])
-                                if timestamp > cutoff_date:
-                                    new_lines.append(line)
-                            except:
-                                continue
-                    
-                    # Write back filtered lines
-                    with open(log_file, 'w') as f:
-                        f.writelines(new_lines)
+                    with open(log_file, 'rb') as src:
+                        size = os.fstat(src.fileno()).st_size
+                        offset = self.find_log_cutoff(src, size, cutoff_date)
+                        if offset == 0:
+                            continue
+                        
+                        tmp_file = log_file.with_name(log_file.name + '.tmp')
+                        with open(tmp_file, 'wb') as dst:
+                            self.copy_file_range(src, dst, offset, size - offset)
+                    os.replace(tmp_file, log_file)
                         
             self.logger.info(f"Cleaned up logs older than {self.max_log_age_days} days")
             
         except Exception as e:
             self.logger.error(f"Error cleaning up logs: {e}")
     
+    def find_log_cutoff(self, f, size: int, cutoff_date: datetime) -> int:
+        """Binary-search the offset of the first entry newer than cutoff_date"""
+        # "timestamp" is the first key of every entry and ISO 8601 strings sort in
+        # time order, so the raw bytes are compared without parsing the line
+        cutoff = cutoff_date.isoformat().encode()
+        
+        def line_start(pos):
+            # Start of the first line beginning at or after pos
+            if pos == 0:
+                return 0
+            f.seek(pos - 1)
+            f.readline()
+            return f.tell()
+        
+        def is_old(line):
+            # {"timestamp":"<iso>",... splits into b'{', b'timestamp', b':', b'<iso>', ...
+            fields = line.split(b'"', 4)
+            if len(fields) < 5 or fields[1] != b'timestamp':
+                return True  # unreadable lines are dropped with the old ones
+            return fields[3] <= cutoff
+        
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(line_start(mid))
+            line = f.readline()
+            if line and is_old(line):
+                lo = mid + 1
+            else:
+                hi = mid
+        return line_start(lo)
+    
+    def copy_file_range(self, src, dst, offset: int, count: int):
+        """Copy count bytes from offset in src to dst, in the kernel where possible"""
+        if hasattr(os, 'sendfile'):
+            while count > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        else:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+    
+    def sampler_loop(self):
+        """Refresh latest_system_metrics every sample_interval seconds"""
+        while not self.stop_event.wait(self.sample_interval):
+            system_metrics = self.collect_system_metrics()
+            if system_metrics:
+                # A single reference swap, so readers never need a lock
+                self.latest_system_metrics = system_metrics
+    
     def get_system_status(self) -> Dict:
         """Get current system status"""
-        system_metrics = self.collect_system_metrics()
+        system_metrics = self.latest_system_metrics if self.running else self.collect_system_metrics()
         database_metrics = self.collect_database_metrics()
         
         return {
@@ -320,29 +498,41 @@ class SystemMonitor:
         """Main monitoring loop"""
         self.logger.info("Starting monitoring loop")
         
+        next_tick = time.monotonic()
+        # First cleanup on the first tick, so a monitor restarted daily still trims its logs
+        next_cleanup = next_tick
         while self.running:
             try:
-                # Collect metrics
-                system_metrics = self.collect_system_metrics()
-                database_metrics = self.collect_database_metrics()
+                # One timestamp per tick, shared by the metrics and any alerts
+                tick_time = datetime.now()
+                
+                # Collect metrics; system metrics come from the sampler's latest snapshot
+                system_metrics = self.latest_system_metrics
+                database_metrics = self.collect_database_metrics(tick_time)
                 
                 # Log metrics
                 self.log_metrics(system_metrics, database_metrics)
                 
                 # Check for alerts
-                self.check_alerts(system_metrics, database_metrics)
+                self.check_alerts(system_metrics, database_metrics, tick_time)
                 
-                # Periodic cleanup (once per day)
-                current_time = datetime.now()
-                if current_time.hour == 2 and current_time.minute < 2:  # 2 AM
-                    self.cleanup_old_logs()
-                
-                # Wait for next interval
-                time.sleep(self.log_interval)
+                # Periodic cleanup (once per day), run by the log writer thread
+                if time.monotonic() >= next_cleanup:
+                    self.log_queue.put(CLEANUP_LOGS)
+                    next_cleanup += LOG_CLEANUP_INTERVAL
                 
             except Exception as e:
                 self.logger.error(f"Error in monitoring loop: {e}")
-                time.sleep(60)  # Wait 1 minute before retrying
+            
+            # Wait for the next tick on a fixed monotonic schedule, so the time spent
+            # collecting does not push later ticks back; overrun ticks are skipped
+            next_tick += self.log_interval
+            now = time.monotonic()
+            if now > next_tick:
+                missed = int((now - next_tick) // self.log_interval) + 1
+                self.logger.warning(f"Monitoring tick overran, skipping {missed} interval(s)")
+                next_tick += missed * self.log_interval
+            self.stop_event.wait(next_tick - now)
     
     def start(self):
         """Start monitoring"""
@@ -351,6 +541,12 @@ class SystemMonitor:
             return
         
         self.running = True
+        self.stop_event.clear()
+        self.latest_system_metrics = self.collect_system_metrics()
+        self.sampler_thread = threading.Thread(target=self.sampler_loop, daemon=True)
+        self.sampler_thread.start()
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
         self.monitor_thread = threading.Thread(target=self.monitor_loop, daemon=True)
         self.monitor_thread.start()
         
@@ -362,8 +558,16 @@ class SystemMonitor:
             return
         
         self.running = False
+        self.stop_event.set()
         if self.monitor_thread:
             self.monitor_thread.join(timeout=5)
+        if self.sampler_thread:
+            self.sampler_thread.join(timeout=5)
+        
+        # Let the writer drain what is queued, then close its files
+        self.log_queue.put(None)
+        if self.writer_thread:
+            self.writer_thread.join(timeout=5)
         
         self.logger.info("System monitor stopped")
 
@@ -387,10 +591,15 @@ if __name__ == "__main__":
     # Start monitoring
     monitor.start()
     
-    # Keep main thread alive
+    # Keep main thread alive; signal_handler stops the monitor and exits
     try:
-        while True:
-            time.sleep(1)
+        if hasattr(signal, 'pause'):
+            while True:
+                signal.pause()  # sleeps in the kernel until a signal arrives
+        else:
+            # signal.pause() is POSIX-only
+            while True:
+                time.sleep(1)
     except KeyboardInterrupt:
         pass
     finally:
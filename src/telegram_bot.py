@@ -19,26 +19,50 @@ Author: naholav
 import logging
 import asyncio
 import json
-import threading
+import os
+import re
+import time
+from collections import deque
 from datetime import datetime
-from queue import Queue
-from typing import Optional, List
+from functools import lru_cache, partial
+from typing import Optional, List, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.constants import ParseMode
-from sqlalchemy.orm import Session
-from sqlalchemy import text
-from langdetect import detect, LangDetectException
-import pika
+from sqlalchemy import case, event, func, select, text, update as sql_update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import aio_pika
+import numpy as np
+
+# Optional fast JSON for RabbitMQ message bodies
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Optional sentence embeddings for the semantic answer cache
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
 
 # Import project modules
-from database_models import SessionLocal, RawData, TrainingData, init_db
+from database_models import DATABASE_URL, RawData, TrainingData, init_db, configure_connection
 from config.env_loader import get_config
 
 # Get configuration
 config = get_config()
 
+# Async engine for the handlers (aiosqlite), so database work never blocks the
+# event loop; connections get the same PRAGMAs as the shared sync engine
+async_engine = create_async_engine(DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+event.listen(async_engine.sync_engine, "connect", configure_connection)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -46,57 +70,265 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global queue for receiving answers from AI worker
-answer_queue = Queue()
+# Words of a question, used to build the full-text similarity query
+QUESTION_WORD_RE = re.compile(r"\w+")
+
+# Language detection: Turkish-only letters or common Turkish words settle it
+TURKISH_CHARS_RE = re.compile(r'[çğıöşüÇĞİÖŞÜ]')
+TURKISH_WORDS_RE = re.compile(r'\b(?:merhaba|selam|nedir|nas[ıi]l|neden|hangi|var|yok|ne|zaman|m[ıiuü])\b', re.I)
+# Any letter at all; text without letters keeps the Turkish default
+LETTER_RE = re.compile(r'[^\W\d_]')
+
+# Optional langdetect pass for texts the heuristic reads as English. The bot only
+# tells Turkish from English, so only these profiles are loaded instead of all 55
+DETECT_LANGUAGES = ('tr', 'en')
+# Detection results are cached per message prefix of this length
+LANGUAGE_CACHE_SIZE = 4096
+LANGUAGE_CACHE_TEXT_LENGTH = 200
+
+# langdetect factory with the DETECT_LANGUAGES profiles, loaded on first use
+language_factory = None
+
+# Messages shorter than this are too short to match meaningfully and skip the lookup
+MIN_SIMILARITY_LENGTH = 10
+
+# Recently saved questions as (id, question, lowercased question), newest last;
+# check_similarity scans them before querying the database
+RECENT_QUESTIONS_SIZE = 1000
+recent_questions = deque(maxlen=RECENT_QUESTIONS_SIZE)
+
+# Statements built once at import; SQLAlchemy's compiled cache and the sqlite3
+# statement cache then reuse them instead of re-parsing SQL on every message
+SIMILAR_FTS_QUERY = text("""
+    SELECT raw_data.id, raw_data.question FROM raw_data_fts
+    JOIN raw_data ON raw_data.id = raw_data_fts.rowid
+    WHERE raw_data_fts MATCH :query
+    AND raw_data.id != :current_id  -- Exclude the current question
+    LIMIT 5
+""").columns(RawData.id, RawData.question)
+
+# Questions starting with the pattern: a range scan on idx_raw_data_question
+# (char(1114111) is U+10FFFF, which sorts after every other character)
+SIMILAR_PREFIX_QUERY = text("""
+    SELECT id, question FROM raw_data
+    WHERE question >= :prefix AND question < :prefix || char(1114111)
+    AND id != :current_id  -- Exclude the current question
+    LIMIT 5
+""").columns(RawData.id, RawData.question)
+
+# Rows shorter than the pattern cannot contain it, so the cheap length test runs before LIKE
+SIMILAR_LIKE_QUERY = text("""
+    SELECT id, question FROM raw_data
+    WHERE id != :current_id  -- Exclude the current question
+    AND length(question) >= :min_length
+    AND question LIKE :pattern
+    LIMIT 5
+""").columns(RawData.id, RawData.question)
+
+# /stats counters
+STATS_QUERY = select(
+    func.count(RawData.id),
+    func.coalesce(func.sum(case((RawData.like == 1, 1), else_=0)), 0),
+    func.coalesce(func.sum(case((RawData.like == -1, 1), else_=0)), 0),
+    func.coalesce(func.sum(case((RawData.admin_approved == 1, 1), else_=0)), 0),
+    func.coalesce(func.sum(case((RawData.is_duplicate == True, 1), else_=0)), 0)
+)
+TRAINING_COUNT_QUERY = select(func.count(TrainingData.id))
+
+# Reply posted for every answered question
+RESPONSE_TEMPLATE = (
+    "👤 **Question from @{username}:**\n"
+    "❓ {question}\n\n"
+    "🤖 **AI Assistant ({language}):**\n"
+    "{answer}\n\n"
+    "💡 Was this response helpful?"
+)
+
+# Feedback button labels by current like value: (like label, dislike label)
+FEEDBACK_LABELS = {
+    None: ("👍 Helpful", "👎 Not Helpful"),
+    1: ("👍 Helpful ✓", "👎 Not Helpful"),
+    -1: ("👍 Helpful", "👎 Not Helpful ✓"),
+}
+
+# Feedback button actions: callback action -> (like value, acknowledgement, log line)
+FEEDBACK_ACTIONS = {
+    "like": (1, "👍 Thank you for your feedback!", "👍 Positive"),
+    "dislike": (-1, "👎 Thank you for your feedback. We'll improve!", "👎 Negative"),
+}
+
+# Seconds handle_message waits for the AI worker's answer
+ANSWER_TIMEOUT_SECONDS = 30
+
+# Handlers waiting for an answer from the AI worker: raw_data_id -> future
+pending_answers = {}
+
+# RabbitMQ connection and channel, opened on the bot's event loop by start_rabbitmq
+rabbitmq_connection = None
+rabbitmq_channel = None
+# Publishes waiting for their broker confirm
+publish_tasks = set()
+
+# Outgoing Telegram calls are paced below the Bot API's limit of ~30 messages/s
+OUTBOX_MAX_PER_SECOND = 30
+
+# Outbound queue of (send, future, edit_key) items, created on the bot's event loop
+outbox = None
+# Keyboard edits waiting in the outbox: message key -> newest edit
+pending_edits = {}
+# Running sends, referenced so they are not garbage collected mid-flight
+outbox_tasks = set()
+
+# Messages waiting per chat: chat_id -> asyncio.Queue, drained by one task per chat
+chat_queues = {}
+chat_tasks = set()
+
+# Telegram shows "typing" for about 5 seconds; resend it only after this many seconds
+TYPING_ACTION_SECONDS = 4.0
+# chat_id -> monotonic time until which the last typing action is still visible;
+# entries are removed again once that time has passed
+typing_until = {}
+
+# Semantic answer cache: multilingual model (same as train_model's duplicate check),
+# minimum cosine similarity to reuse an answer, and how many liked answers to load
+ANSWER_CACHE_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+ANSWER_CACHE_THRESHOLD = 0.9
+ANSWER_CACHE_SIZE = 5000
+# Set once the cache is loaded (see load_answer_cache)
+answer_cache = None
 
 
-def detect_language(text: str) -> str:
+def get_language_factory():
+    """Load the langdetect profiles for DETECT_LANGUAGES once"""
+    global language_factory
+    if language_factory is None:
+        # Imported here so the bot runs without langdetect while the fallback is off
+        from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+        
+        profiles = []
+        for lang in DETECT_LANGUAGES:
+            with open(os.path.join(PROFILES_DIRECTORY, lang), encoding='utf-8') as f:
+                profiles.append(f.read())
+        factory = DetectorFactory()
+        factory.load_json_profile(profiles)
+        factory.set_seed(0)  # deterministic, so cached results match fresh ones
+        language_factory = factory
+    return language_factory
+
+
+async def detect_language(text: str) -> str:
     """
     Detect the language of the input text.
     
+    The langdetect fallback is CPU-bound, so it runs in the default executor
+    rather than on the event loop.
+    
     Args:
         text: Input text to analyze
         
     Returns:
         Language code ('TR' for Turkish, 'EN' for English)
     """
+    if TURKISH_CHARS_RE.search(text) or TURKISH_WORDS_RE.search(text):
+        return 'TR'
+    
+    if config.langdetect_fallback:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, detect_language_cached, text.strip()[:LANGUAGE_CACHE_TEXT_LENGTH]
+        )
+    
+    return 'EN' if LETTER_RE.search(text) else 'TR'  # Default to Turkish for Cukurova University
+
+
+@lru_cache(maxsize=LANGUAGE_CACHE_SIZE)
+def detect_language_cached(text: str) -> str:
+    """Detect the language of a normalized message, memoizing repeats"""
+    from langdetect import LangDetectException
+    
     try:
-        detected_lang = detect(text)
+        detector = get_language_factory().create()
+        detector.append(text)
+        detected_lang = detector.detect()
         return 'TR' if detected_lang == 'tr' else 'EN'
     except LangDetectException:
         logger.warning(f"Could not detect language for text: {text[:50]}...")
         return 'TR'  # Default to Turkish for Cukurova University
 
 
-def check_similarity(db: Session, question: str) -> List[tuple]:
+def feedback_keyboard(raw_data_id: int, like: Optional[int] = None) -> InlineKeyboardMarkup:
+    """Build the like/dislike keyboard for an answer, marking the selected button"""
+    like_label, dislike_label = FEEDBACK_LABELS.get(like, FEEDBACK_LABELS[None])
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(like_label, callback_data=f"like_{raw_data_id}"),
+            InlineKeyboardButton(dislike_label, callback_data=f"dislike_{raw_data_id}")
+        ]
+    ])
+
+
+async def check_similarity(db: AsyncSession, question: str, current_id: int) -> List[tuple]:
     """
     Check for similar questions in the database using simple text matching.
     
-    This function performs a basic similarity check by looking for questions
-    that contain similar text patterns. In production, this could be enhanced
-    with other similarity algorithms.
+    This function performs a basic similarity check. Recently saved questions
+    containing the question's opening are found in memory (recent_questions);
+    otherwise it looks up questions that contain the words of the opening
+    through the raw_data_fts full-text index. When that index is missing it looks up questions with
+    the same opening on the question index, then falls back to a LIKE scan.
+    In production, this could be enhanced with other similarity algorithms.
     
     Args:
         db: Database session
         question: The question text to check
+        current_id: ID of the question's own row, excluded from the results
         
     Returns:
         List of similar questions as (id, question) tuples
     """
+    # Cheapest check first: very short messages never reach the database
+    if len(question.strip()) < MIN_SIMILARITY_LENGTH:
+        return []
+    
     try:
-        # Simple similarity check using LIKE pattern matching
         # Take the first 20 characters as a pattern to find similar questions
         pattern = question[:20]
         
-        results = db.execute(
-            text("""
-            SELECT id, question FROM raw_data 
-            WHERE question LIKE :pattern
-            AND id != (SELECT MAX(id) FROM raw_data)  -- Exclude the most recent (current) question
-            LIMIT 5
-            """),
-            {"pattern": f"%{pattern}%"}
-        ).fetchall()
+        # Repeats usually follow soon after the original, so try recent questions first;
+        # oldest first, so a duplicate points at the original rather than another repeat
+        needle = pattern.lower()
+        results = [
+            (question_id, text) for question_id, text, lowered in recent_questions
+            if needle in lowered and question_id != current_id
+        ][:5]
+        if results:
+            logger.info(f"Found {len(results)} similar recent questions for pattern: {pattern}")
+            return results
+        
+        # Every word of the pattern must occur; the last one may be cut off, so
+        # it is matched as a prefix
+        words = QUESTION_WORD_RE.findall(pattern)
+        if not words:
+            return []
+        fts_query = ' '.join(f'"{word}"' for word in words) + '*'
+        
+        try:
+            results = (await db.execute(
+                SIMILAR_FTS_QUERY,
+                {"query": fts_query, "current_id": current_id}
+            )).fetchall()
+        except OperationalError:
+            # No full-text index (SQLite without FTS5): questions with the same
+            # opening come straight from the question index
+            results = (await db.execute(
+                SIMILAR_PREFIX_QUERY,
+                {"prefix": pattern, "current_id": current_id}
+            )).fetchall()
+            if not results:
+                # Otherwise scan with LIKE pattern matching
+                results = (await db.execute(
+                    SIMILAR_LIKE_QUERY,
+                    {"pattern": f"%{pattern}%", "min_length": len(pattern), "current_id": current_id}
+                )).fetchall()
         
         logger.info(f"Found {len(results)} similar questions for pattern: {pattern}")
         return results
@@ -106,86 +338,371 @@ def check_similarity(db: Session, question: str) -> List[tuple]:
         return []
 
 
-def send_to_rabbitmq(message_data: dict) -> bool:
+class AnswerCache:
     """
-    Send question data to RabbitMQ for AI processing.
+    In-memory semantic cache of answers users liked.
     
-    Args:
-        message_data: Dictionary containing question data
+    Questions are embedded with a sentence-transformer and kept as int8-quantized
+    unit vectors, so a lookup is one matrix-vector product and a paraphrase of a
+    liked question can be answered without a round-trip to the AI worker. The
+    multilingual model puts a question and its translation close together, so
+    answers are only reused for questions in the same language.
+    """
+    
+    def __init__(self, model):
+        self.model = model
+        self.ids = []
+        self.languages = []
+        self.answers = []
+        self.vectors = np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.int8)
+    
+    def embed(self, questions: List[str]) -> np.ndarray:
+        """
+        Embed questions as int8-quantized unit vectors (blocking; run in an executor).
         
-    Returns:
-        True if message was sent successfully, False otherwise
+        Args:
+            questions: Question texts to embed
+            
+        Returns:
+            Array of shape (len(questions), dimension) scaled to -127..127
+        """
+        embeddings = self.model.encode(questions, normalize_embeddings=True, convert_to_numpy=True)
+        return np.round(embeddings * 127).astype(np.int8)
+    
+    async def lookup(self, question: str, language: str) -> Optional[Tuple[int, str, float]]:
+        """
+        Find the cached answer for the most similar liked question in the same language.
+        
+        Args:
+            question: The question text to look up
+            language: Detected language of the question ('TR' or 'EN')
+            
+        Returns:
+            (raw_data_id, answer, similarity) above ANSWER_CACHE_THRESHOLD, or None
+        """
+        if not self.ids:
+            return None
+        vector = (await asyncio.get_running_loop().run_in_executor(None, self.embed, [question]))[0]
+        
+        # Dot products of unit vectors are cosine similarities, scaled by 127²
+        scores = self.vectors.astype(np.int32) @ vector.astype(np.int32)
+        scores[np.asarray(self.languages) != language] = -1
+        best = int(np.argmax(scores))
+        similarity = scores[best] / (127 * 127)
+        if similarity < ANSWER_CACHE_THRESHOLD:
+            return None
+        return self.ids[best], self.answers[best], float(similarity)
+    
+    async def add(self, raw_data_id: int, question: str, language: str, answer: str) -> None:
+        """
+        Cache a liked answer, replacing any earlier entry for the same question.
+        
+        Args:
+            raw_data_id: ID of the liked question
+            question: The question text
+            language: Language of the question ('TR' or 'EN')
+            answer: The answer users liked
+        """
+        vector = await asyncio.get_running_loop().run_in_executor(None, self.embed, [question])
+        self.discard(raw_data_id)
+        self.ids.append(raw_data_id)
+        self.languages.append(language)
+        self.answers.append(answer)
+        self.vectors = np.vstack((self.vectors, vector))
+    
+    def discard(self, raw_data_id: int) -> None:
+        """
+        Drop a question's answer from the cache, e.g. after a dislike.
+        
+        Args:
+            raw_data_id: ID of the question to drop
+        """
+        if raw_data_id in self.ids:
+            index = self.ids.index(raw_data_id)
+            del self.ids[index]
+            del self.languages[index]
+            del self.answers[index]
+            self.vectors = np.delete(self.vectors, index, axis=0)
+
+
+async def load_answer_cache() -> None:
+    """
+    Load the embedding model and the newest liked answers into the answer cache.
+    
+    Runs as a background task after startup; questions go to the AI worker
+    until the cache is ready.
     """
+    global answer_cache
     try:
-        # Establish RabbitMQ connection
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(config.rabbitmq_host, config.rabbitmq_port)
-        )
-        channel = connection.channel()
-        
-        # Declare the questions queue
-        channel.queue_declare(queue=config.questions_queue, durable=True)
-        
-        # Send message to queue
-        channel.basic_publish(
-            exchange='',
-            routing_key=config.questions_queue,
-            body=json.dumps(message_data),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # Make message persistent
-            )
-        )
+        loop = asyncio.get_running_loop()
+        model = await loop.run_in_executor(None, SentenceTransformer, ANSWER_CACHE_MODEL)
+        cache = AnswerCache(model)
+        
+        db = AsyncSessionLocal()
+        try:
+            rows = (await db.execute(
+                select(RawData.id, RawData.question, RawData.language, RawData.answer)
+                .where(RawData.like == 1, RawData.answer.isnot(None))
+                .order_by(RawData.id.desc())
+                .limit(ANSWER_CACHE_SIZE)
+            )).all()
+        finally:
+            await db.close()
         
-        connection.close()
-        logger.info(f"✅ Sent question to RabbitMQ: ID {message_data.get('raw_data_id')}")
-        return True
+        if rows:
+            cache.ids = [row.id for row in rows]
+            cache.languages = [row.language for row in rows]
+            cache.answers = [row.answer for row in rows]
+            cache.vectors = await loop.run_in_executor(None, cache.embed, [row.question for row in rows])
         
+        answer_cache = cache
+        logger.info(f"⚡ Answer cache ready with {len(rows)} liked answers")
     except Exception as e:
-        logger.error(f"❌ Failed to send message to RabbitMQ: {e}")
-        return False
+        logger.error(f"❌ Answer cache unavailable: {e}")
+
+
+def dumps_message(data: dict) -> bytes:
+    """Encode a RabbitMQ message body"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
 
+def loads_message(body: bytes) -> dict:
+    """Decode a RabbitMQ message body"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(body)
+    return json.loads(body)
 
-def start_answer_consumer():
+
+def send_to_rabbitmq(message_data: dict) -> None:
     """
-    Start the RabbitMQ consumer for receiving AI-generated answers.
+    Send question data to RabbitMQ for AI processing without waiting for the broker.
+    
+    The publish and its publisher confirm run in a background task. If the
+    broker rejects the message or the publish fails, the handler waiting in
+    pending_answers gets the error instead of an answer.
     
-    This function runs in a separate thread to listen for answers from
-    the AI worker and puts them in the global answer queue.
+    Args:
+        message_data: Dictionary containing question data
     """
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(config.rabbitmq_host, config.rabbitmq_port)
-        )
-        channel = connection.channel()
+    task = asyncio.create_task(publish_question(message_data))
+    publish_tasks.add(task)
+    task.add_done_callback(partial(on_publish_confirmed, message_data['raw_data_id']))
+
+
+async def publish_question(message_data: dict) -> None:
+    """Publish one question and wait for the broker's confirm"""
+    # Send message to queue over the shared connection
+    await rabbitmq_channel.default_exchange.publish(
+        aio_pika.Message(
+            body=dumps_message(message_data),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,  # Make message persistent
+        ),
+        routing_key=config.questions_queue
+    )
+
+
+def on_publish_confirmed(raw_data_id: int, task: asyncio.Task) -> None:
+    """Log the broker's confirm for a question, or fail the handler waiting for its answer"""
+    publish_tasks.discard(task)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is None:
+        logger.info(f"✅ Sent question to RabbitMQ: ID {raw_data_id}")
+        return
+    
+    logger.error(f"❌ Failed to send message to RabbitMQ: {error}")
+    future = pending_answers.get(raw_data_id)
+    if future is not None and not future.done():
+        future.set_exception(error)
+
+
+async def outbox_worker(queue: asyncio.Queue) -> None:
+    """
+    Start queued Telegram API calls at no more than OUTBOX_MAX_PER_SECOND.
+    
+    Calls are started in queue order but not awaited here, so a slow request
+    does not hold back the ones behind it.
+    """
+    loop = asyncio.get_running_loop()
+    interval = 1 / OUTBOX_MAX_PER_SECOND
+    next_send = loop.time()
+    
+    while True:
+        send, future, edit_key = await queue.get()
+        if edit_key is not None:
+            # Only the newest edit queued for this message is sent
+            send = pending_edits.pop(edit_key)
         
-        # Declare the answers queue
-        channel.queue_declare(queue=config.answers_queue, durable=True)
+        delay = next_send - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        next_send = max(next_send, loop.time()) + interval
         
-        def callback(ch, method, properties, body):
-            """Process incoming answer from AI worker."""
-            try:
-                answer_data = json.loads(body)
-                answer_queue.put(answer_data)
-                logger.info(f"📥 Received answer from AI worker: ID {answer_data.get('raw_data_id')}")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-            except Exception as e:
-                logger.error(f"❌ Error processing answer: {e}")
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-        
-        channel.basic_consume(queue=config.answers_queue, on_message_callback=callback)
-        logger.info("🔄 Started consuming answers from RabbitMQ")
-        channel.start_consuming()
+        task = asyncio.create_task(deliver_outbound(send, future))
+        outbox_tasks.add(task)
+        task.add_done_callback(outbox_tasks.discard)
+
+
+async def deliver_outbound(send, future: Optional[asyncio.Future]) -> None:
+    """Run one queued Telegram API call and hand its result to the waiting caller"""
+    try:
+        result = await send()
+    except Exception as e:
+        if future is None:
+            logger.error(f"❌ Outbound Telegram call failed: {e}")
+        elif not future.done():
+            future.set_exception(e)
+        return
+    if future is not None and not future.done():
+        future.set_result(result)
+
+
+def get_outbox() -> asyncio.Queue:
+    """Return the outbound queue, starting its worker on first use"""
+    global outbox
+    if outbox is None:
+        outbox = asyncio.Queue()
+        task = asyncio.create_task(outbox_worker(outbox))
+        outbox_tasks.add(task)
+    return outbox
+
+
+async def send_outbound(send):
+    """
+    Queue a Telegram API call and wait for its result.
+    
+    Args:
+        send: Zero-argument callable returning the API coroutine
+    """
+    future = asyncio.get_running_loop().create_future()
+    get_outbox().put_nowait((send, future, None))
+    return await future
+
+
+def queue_keyboard_edit(key, send) -> None:
+    """
+    Queue a reply-markup edit without waiting for it.
+    
+    An edit still waiting for the same message (same key) is replaced, so rapid
+    button presses on one message collapse into a single API call.
+    """
+    if key not in pending_edits:
+        get_outbox().put_nowait((None, None, key))
+    pending_edits[key] = send
+
+
+async def start_rabbitmq(application: Application) -> None:
+    """
+    Connect to RabbitMQ on the bot's event loop and start consuming answers.
+    
+    The robust connection reconnects by itself and restores the channel, the
+    queue declarations and the consumer, so questions and answers share one
+    long-lived connection for the lifetime of the bot.
+    """
+    global rabbitmq_connection, rabbitmq_channel
+    rabbitmq_connection = await aio_pika.connect_robust(host=config.rabbitmq_host, port=config.rabbitmq_port)
+    # Publisher confirms: every publish is acknowledged by the broker once it is stored
+    rabbitmq_channel = await rabbitmq_connection.channel(publisher_confirms=True)
+    
+    # Declare the questions and answers queues
+    await rabbitmq_channel.declare_queue(config.questions_queue, durable=True)
+    answers_queue = await rabbitmq_channel.declare_queue(config.answers_queue, durable=True)
+    
+    await answers_queue.consume(on_answer)
+    logger.info("🔄 Started consuming answers from RabbitMQ")
+
+
+async def load_recent_questions() -> None:
+    """Fill recent_questions with the newest saved questions, so lookups start warm"""
+    db = AsyncSessionLocal()
+    try:
+        rows = (await db.execute(
+            select(RawData.id, RawData.question)
+            .where(RawData.question.isnot(None))
+            .order_by(RawData.id.desc())
+            .limit(RECENT_QUESTIONS_SIZE)
+        )).all()
+    finally:
+        await db.close()
+    
+    recent_questions.extend((row.id, row.question, row.question.lower()) for row in reversed(rows))
+    logger.info(f"🕘 Loaded {len(rows)} recent questions for similarity checks")
+
+
+async def post_init(application: Application) -> None:
+    """
+    Connect RabbitMQ, preload recent questions and the langdetect profiles and,
+    when enabled, start loading the answer cache in the background.
+    
+    Args:
+        application: The Telegram application being started
+    """
+    await start_rabbitmq(application)
+    await load_recent_questions()
+    
+    # Load the langdetect profiles off the event loop before the first message needs them
+    if config.langdetect_fallback:
+        await asyncio.get_running_loop().run_in_executor(None, get_language_factory)
+    
+    if config.answer_cache:
+        if SENTENCE_TRANSFORMERS_AVAILABLE:
+            application.create_task(load_answer_cache())
+        else:
+            logger.warning("⚠️ ANSWER_CACHE is enabled but sentence-transformers is not installed")
+
+
+async def stop_rabbitmq(application: Application) -> None:
+    """Close the RabbitMQ connection when the bot shuts down"""
+    if rabbitmq_connection is not None:
+        await rabbitmq_connection.close()
+
+
+async def post_shutdown(application: Application) -> None:
+    """
+    Close RabbitMQ and the database connections when the bot shuts down.
+    
+    aiosqlite runs each connection on a non-daemon thread, so pooled
+    connections would keep the process alive after polling stops.
+    
+    Args:
+        application: The Telegram application being stopped
+    """
+    await stop_rabbitmq(application)
+    await async_engine.dispose()
+
+
+async def on_answer(message: aio_pika.abc.AbstractIncomingMessage) -> None:
+    """
+    Process incoming answer from AI worker.
+    
+    Runs on the bot's event loop and hands the answer straight to the
+    handler waiting for it.
+    """
+    try:
+        answer_data = loads_message(message.body)
+        logger.info(f"📥 Received answer from AI worker: ID {answer_data.get('raw_data_id')}")
         
+        future = pending_answers.pop(answer_data.get('raw_data_id'), None)
+        if future is not None and not future.done():
+            future.set_result(answer_data)
+        else:
+            logger.warning(f"⚠️ No handler waiting for answer ID {answer_data.get('raw_data_id')}, dropping it")
+        await message.ack()
     except Exception as e:
-        logger.error(f"❌ RabbitMQ answer consumer error: {e}")
+        logger.error(f"❌ Error processing answer: {e}")
+        await message.reject(requeue=False)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handle incoming messages from Telegram users.
     
-    This function processes user messages, detects language, checks for duplicates,
-    saves to database, sends to AI worker via RabbitMQ, and responds to user.
+    Messages are queued per chat and processed by that chat's worker task, so
+    the handler returns immediately: a chat waiting on the AI worker does not
+    hold up updates from other chats, while each chat keeps its message order.
     
     Args:
         update: Telegram update object containing message data
@@ -199,21 +716,60 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if config.telegram_topic_id and update.message.message_thread_id != config.telegram_topic_id:
         return
     
+    # Skip command messages (those starting with '/')
+    if update.message.text.startswith('/'):
+        return
+    
+    chat_id = update.message.chat_id
+    queue = chat_queues.get(chat_id)
+    if queue is None:
+        queue = chat_queues[chat_id] = asyncio.Queue()
+        task = asyncio.create_task(drain_chat_queue(chat_id, queue))
+        chat_tasks.add(task)
+        task.add_done_callback(chat_tasks.discard)
+    queue.put_nowait(update)
+
+
+async def drain_chat_queue(chat_id: int, queue: asyncio.Queue) -> None:
+    """Process a chat's queued messages one at a time, then retire the queue"""
+    while not queue.empty():
+        update = queue.get_nowait()
+        try:
+            await process_message(update)
+        except Exception as e:
+            logger.error(f"❌ Error processing message in chat {chat_id}: {e}")
+    
+    # No await since the empty check, so no message can slip in unprocessed
+    del chat_queues[chat_id]
+
+
+def expire_typing(chat_id: int) -> None:
+    """Forget a chat's typing window once it has passed, so typing_until stays small"""
+    if typing_until.get(chat_id, float('inf')) <= time.monotonic():
+        del typing_until[chat_id]
+
+
+async def process_message(update: Update) -> None:
+    """
+    Process one user message.
+    
+    This function detects language, checks for duplicates, saves to database,
+    sends to AI worker via RabbitMQ, and responds to user.
+    
+    Args:
+        update: Telegram update object containing message data
+    """
     # Extract user and message information
     user = update.effective_user
     message_text = update.message.text
     
-    # Skip command messages (those starting with '/')
-    if message_text.startswith('/'):
-        return
-    
     logger.info(f"📩 Received message from {user.username or user.first_name}: {message_text[:50]}...")
     
     # Initialize database session
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Detect language of the message
-        detected_language = detect_language(message_text)
+        detected_language = await detect_language(message_text)
         logger.info(f"🌍 Detected language: {detected_language}")
         
         # Create new raw data entry in database
@@ -225,26 +781,33 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             message_thread_id=update.message.message_thread_id
         )
         db.add(raw_data)
-        db.commit()
-        db.refresh(raw_data)
-        
-        logger.info(f"💾 Saved question to database with ID: {raw_data.id}")
+        await db.flush()  # the INSERT's lastrowid fills in raw_data.id, no refresh needed
+        raw_data_id = raw_data.id
         
         # Check for duplicate questions
-        similar_questions = check_similarity(db, message_text)
+        similar_questions = await check_similarity(db, message_text, raw_data_id)
         if similar_questions and len(similar_questions) > 0:
             # Mark as duplicate and reference the first similar question
             raw_data.is_duplicate = True
             raw_data.duplicate_of_id = similar_questions[0][0]
-            db.commit()
             logger.info(f"🔄 Marked as duplicate of question ID: {similar_questions[0][0]}")
         
-        # Show typing indicator to user
-        await update.message.chat.send_action("typing")
+        # One commit for the question and its duplicate mark; it must land before
+        # the AI worker looks the row up
+        await db.commit()
+        recent_questions.append((raw_data_id, message_text, message_text.lower()))
+        logger.info(f"💾 Saved question to database with ID: {raw_data_id}")
+        
+        # Show typing indicator to user, unless one sent for this chat is still visible
+        now = time.monotonic()
+        if typing_until.get(update.message.chat_id, 0.0) < now:
+            typing_until[update.message.chat_id] = now + TYPING_ACTION_SECONDS
+            asyncio.get_running_loop().call_later(TYPING_ACTION_SECONDS, expire_typing, update.message.chat_id)
+            await update.message.chat.send_action("typing")
         
         # Prepare message data for RabbitMQ
         message_data = {
-            'raw_data_id': raw_data.id,
+            'raw_data_id': raw_data_id,
             'telegram_id': user.id,
             'username': user.username or user.first_name,
             'question': message_text,
@@ -253,81 +816,77 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             'update_message_id': update.message.message_id
         }
         
-        # Send question to AI worker via RabbitMQ
-        if not send_to_rabbitmq(message_data):
-            # Fallback: respond with error message
-            await update.message.reply_text(
-                "⚠️ Sorry, I'm experiencing technical difficulties. Please try again later or contact the department office: +90 322 338 60 10"
-            )
-            return
-        
-        # Wait for AI response with timeout
-        timeout_seconds = 30
-        start_time = asyncio.get_event_loop().time()
-        model_response = None
-        
-        while True:
-            # Check for timeout
-            if asyncio.get_event_loop().time() - start_time > timeout_seconds:
-                model_response = "⏰ Response timeout. Please try again later or contact the department office for assistance."
-                break
+        # A paraphrase of a liked question is answered from the cache, skipping the AI worker
+        cached = await answer_cache.lookup(message_text, detected_language) if answer_cache else None
+        if cached:
+            model_response = cached[1]
+            logger.info(f"⚡ Answered from cache: question ID {cached[0]} (similarity {cached[2]:.2f})")
+        else:
+            # Register for the answer before publishing, so a fast reply is not missed
+            answer_future = asyncio.get_running_loop().create_future()
+            pending_answers[raw_data_id] = answer_future
             
-            # Check for response in queue
-            if not answer_queue.empty():
-                answer_data = answer_queue.get()
-                if answer_data['raw_data_id'] == raw_data.id:
-                    model_response = answer_data['answer']
-                    break
-                else:
-                    # Put back if not for current question
-                    answer_queue.put(answer_data)
+            # Send question to AI worker via RabbitMQ; the broker confirms in the background
+            send_to_rabbitmq(message_data)
             
-            # Wait a bit before checking again
-            await asyncio.sleep(0.5)
-        
-        # Update database with AI response
-        raw_data.answer = model_response
-        raw_data.answered_at = datetime.utcnow()
-        db.commit()
+            # Wait for AI response with timeout
+            try:
+                answer_data = await asyncio.wait_for(answer_future, timeout=ANSWER_TIMEOUT_SECONDS)
+                model_response = answer_data['answer']
+            except asyncio.TimeoutError:
+                model_response = "⏰ Response timeout. Please try again later or contact the department office for assistance."
+            except Exception:
+                # The question never reached RabbitMQ: respond with error message
+                await send_outbound(partial(
+                    update.message.reply_text,
+                    "⚠️ Sorry, I'm experiencing technical difficulties. Please try again later or contact the department office: +90 322 338 60 10"
+                ))
+                return
+            finally:
+                pending_answers.pop(raw_data_id, None)
+        answered_at = datetime.utcnow()
         
         # Create inline keyboard for user feedback
-        keyboard = [
-            [
-                InlineKeyboardButton("👍 Helpful", callback_data=f"like_{raw_data.id}"),
-                InlineKeyboardButton("👎 Not Helpful", callback_data=f"dislike_{raw_data.id}")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = feedback_keyboard(raw_data_id)
         
         # Format response message
-        response_text = (
-            f"👤 **Question from @{user.username or user.first_name}:**\n"
-            f"❓ {message_text}\n\n"
-            f"🤖 **AI Assistant ({detected_language}):**\n"
-            f"{model_response}\n\n"
-            f"💡 Was this response helpful?"
+        response_text = RESPONSE_TEMPLATE.format(
+            username=user.username or user.first_name,
+            question=message_text,
+            language=detected_language,
+            answer=model_response
         )
         
         # Send response to user
-        sent_message = await update.message.reply_text(
+        sent_message = await send_outbound(partial(
+            update.message.reply_text,
             response_text,
             reply_markup=reply_markup,
             parse_mode=ParseMode.MARKDOWN
-        )
+        ))
         
-        # Save Telegram message ID for future reference
-        raw_data.telegram_message_id = sent_message.message_id
-        db.commit()
+        # Save the AI response and the Telegram message ID in a single UPDATE
+        await db.execute(
+            sql_update(RawData)
+            .where(RawData.id == raw_data_id)
+            .values(
+                answer=model_response,
+                answered_at=answered_at,
+                telegram_message_id=sent_message.message_id
+            )
+        )
+        await db.commit()
         
         logger.info(f"✅ Sent response to user: {user.username or user.first_name}")
         
     except Exception as e:
         logger.error(f"❌ Error handling message: {e}")
-        await update.message.reply_text(
+        await send_outbound(partial(
+            update.message.reply_text,
             "❌ An error occurred. Please try again later."
-        )
+        ))
     finally:
-        db.close()
+        await db.close()
 
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -342,53 +901,48 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
     
     try:
-        # Parse callback data (format: "action_rawdataid")
-        action, raw_data_id = query.data.split('_')
+        # Parse callback data (format: "action_rawdataid"; the id is always the last field)
+        action, _, raw_data_id = query.data.rpartition('_')
+        feedback = FEEDBACK_ACTIONS.get(action)
+        if feedback is None:
+            await query.answer("❌ Invalid action!", show_alert=True)
+            return
+        like, acknowledgement, log_label = feedback
         raw_data_id = int(raw_data_id)
         
-        db = SessionLocal()
+        db = AsyncSessionLocal()
         try:
             # Find the raw data record
-            raw_data = db.query(RawData).filter(RawData.id == raw_data_id).first()
+            raw_data = await db.get(RawData, raw_data_id)
             if not raw_data:
                 await query.answer("❌ Record not found!", show_alert=True)
                 return
             
             # Update feedback based on action
-            if action == "like":
-                raw_data.like = 1  # Positive feedback
-                await query.answer("👍 Thank you for your feedback!")
-                logger.info(f"👍 Positive feedback from {query.from_user.username} for question ID: {raw_data_id}")
-            elif action == "dislike":
-                raw_data.like = -1  # Negative feedback
-                await query.answer("👎 Thank you for your feedback. We'll improve!")
-                logger.info(f"👎 Negative feedback from {query.from_user.username} for question ID: {raw_data_id}")
-            else:
-                await query.answer("❌ Invalid action!", show_alert=True)
-                return
+            raw_data.like = like
+            await query.answer(acknowledgement)
+            logger.info(f"{log_label} feedback from {query.from_user.username} for question ID: {raw_data_id}")
             
-            db.commit()
+            await db.commit()
             
             # Update the inline keyboard to show selected feedback
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "👍 Helpful" + (" ✓" if raw_data.like == 1 else ""), 
-                        callback_data=f"like_{raw_data_id}"
-                    ),
-                    InlineKeyboardButton(
-                        "👎 Not Helpful" + (" ✓" if raw_data.like == -1 else ""), 
-                        callback_data=f"dislike_{raw_data_id}"
-                    )
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = feedback_keyboard(raw_data_id, like)
+            
+            # Update the message with new keyboard (queued; superseded by a newer press)
+            queue_keyboard_edit(
+                (query.message.chat_id, query.message.message_id) if query.message else query.inline_message_id,
+                partial(query.edit_message_reply_markup, reply_markup=reply_markup)
+            )
             
-            # Update the message with new keyboard
-            await query.edit_message_reply_markup(reply_markup=reply_markup)
+            # Liked answers are reused for paraphrased questions; disliked ones never are
+            if answer_cache:
+                if like == 1 and raw_data.answer:
+                    await answer_cache.add(raw_data_id, raw_data.question, raw_data.language, raw_data.answer)
+                else:
+                    answer_cache.discard(raw_data_id)
             
         finally:
-            db.close()
+            await db.close()
             
     except Exception as e:
         logger.error(f"❌ Error handling callback: {e}")
@@ -432,15 +986,13 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         update: Telegram update object
         context: Telegram context for bot operations
     """
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
-        # Gather statistics from database
-        total_questions = db.query(RawData).count()
-        liked_questions = db.query(RawData).filter(RawData.like == 1).count()
-        disliked_questions = db.query(RawData).filter(RawData.like == -1).count()
-        approved_questions = db.query(RawData).filter(RawData.admin_approved == 1).count()
-        training_data_count = db.query(TrainingData).count()
-        duplicate_count = db.query(RawData).filter(RawData.is_duplicate == True).count()
+        # Gather statistics from database: one pass over raw_data for all of its counters
+        total_questions, liked_questions, disliked_questions, approved_questions, duplicate_count = (
+            await db.execute(STATS_QUERY)
+        ).one()
+        training_data_count = await db.scalar(TRAINING_COUNT_QUERY)
         
         # Calculate success rate
         total_feedback = liked_questions + disliked_questions
@@ -470,14 +1022,14 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.error(f"❌ Error getting statistics: {e}")
         await update.message.reply_text("❌ Could not retrieve statistics.")
     finally:
-        db.close()
+        await db.close()
 
 
 def main() -> None:
     """
     Main function to start the Telegram bot.
     
-    Initializes the database, starts the RabbitMQ consumer, and runs the bot.
+    Initializes the database, connects RabbitMQ on startup, and runs the bot.
     """
     logger.info("🚀 Starting CengBot Telegram Bot...")
     
@@ -485,13 +1037,14 @@ def main() -> None:
     init_db()
     logger.info("✅ Database initialized")
     
-    # Start RabbitMQ answer consumer in background thread
-    consumer_thread = threading.Thread(target=start_answer_consumer, daemon=True)
-    consumer_thread.start()
-    logger.info("✅ RabbitMQ answer consumer started")
-    
-    # Create Telegram bot application
-    application = Application.builder().token(config.telegram_bot_token).build()
+    # Create Telegram bot application; RabbitMQ is connected on the bot's event loop
+    application = (
+        Application.builder()
+        .token(config.telegram_bot_token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -111,11 +111,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             message_thread_id=update.message.message_thread_id
         )
         db.add(raw_data)
-        db.commit()
-        db.refresh(raw_data)
+        db.flush()
         
         # Automatically check for duplicates using cosine similarity
-        mark_duplicate_questions(db, raw_data.id, raw_data.question)
+        mark_duplicate_questions(db, raw_data.id, raw_data.question, commit=False)
+        db.commit()
         
         # Send typing action
         await update.message.chat.send_action("typing")
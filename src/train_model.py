@@ -301,7 +301,7 @@ class DataProcessor:
                 if export_result["success"]:
                     logger.info(f"✅ Database export successful: {export_result['message']}")
                     stats = export_result['statistics']
-                    logger.info(f"📊 Exported {stats['total_entries']} entries: {stats['by_language']}")
+                    logger.info(f"📊 Exported {stats['new_entries']} new entries: {stats['by_language']}")
                 else:
                     logger.error(f"❌ Database export failed: {export_result['message']}")
                     if dataset_exists: